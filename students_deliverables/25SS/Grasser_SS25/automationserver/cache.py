@@ -0,0 +1,150 @@
+"""Caches: an in-process LRU, an optional Redis backend with the same interface, and a fragment cache on top of either"""
+
+import collections
+import json
+import threading
+import time
+import uuid
+from typing import Any, Callable, Hashable, Optional
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache:
+    """A thread safe, size bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        """Maximum number of entries"""
+        self.hits = 0
+        """Number of successful lookups, for monitoring"""
+        self.misses = 0
+        """Number of failed lookups, for monitoring"""
+
+        self._data: collections.OrderedDict[Hashable, Any] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the entry for `key` (marking it as recently used) or `default`"""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        """Insert or replace the entry for `key`, evicting the oldest entry if full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_if(self, key: Hashable, value: Any, predicate: Callable[[Any], bool]) -> bool:
+        """Insert the entry, unless there is an existing one for which `predicate(existing)` is false.
+        Returns whether the entry was stored"""
+        with self._lock:
+            if key in self._data and not predicate(self._data[key]):
+                return False
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key: Hashable):
+        """Remove the entry for `key`, if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RedisCache:
+    """A cache with the `get`/`set`/`delete` interface of `LRUCache`, kept in a Redis compatible server (Redis, Valkey, ...)
+    and thereby shared by every worker process. Keys and values have to be JSON serializable; tuples come back as lists.
+    Needs the optional `redis` package"""
+
+    def __init__(self, url: str, prefix: str = "cache:", ttl_s: Optional[int] = 3600):
+        if redis is None: raise RuntimeError("RedisCache needs the redis package")
+        self.client = redis.Redis.from_url(url)
+        """Connection pool to the server"""
+        self.prefix = prefix
+        """Namespace of this cache's keys on the server"""
+        self.ttl_s = ttl_s
+        """Expiry of every entry, so the server's memory is bounded even without an eviction policy"""
+
+    def _key(self, key: Hashable) -> str:
+        return self.prefix + json.dumps(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self.client.get(self._key(key))
+        return default if value is None else json.loads(value)
+
+    def set(self, key: Hashable, value: Any):
+        self.client.set(self._key(key), json.dumps(value), ex=self.ttl_s)
+
+    def delete(self, key: Hashable):
+        self.client.delete(self._key(key))
+
+
+def make_cache(url: Optional[str], maxsize: int = 1024, prefix: str = "cache:") -> LRUCache | RedisCache:
+    """A `RedisCache` for a `redis://` (or `rediss://`, `unix://`) URL, an in-process `LRUCache` otherwise"""
+    if url: return RedisCache(url, prefix=prefix)
+    return LRUCache(maxsize)
+
+
+class FragmentCache:
+    """Rendered pages (or parts of them) by namespace and key, for at most `ttl_s` seconds
+
+    Every namespace has a generation token, which is part of the keys of its fragments. Invalidating a namespace
+    replaces the token, so all its fragments become unreachable at once (and age out of the backend) without
+    enumerating them. Invalidating with a version as token (e.g. the ETag of a notebook) keys the fragments by that version"""
+
+    def __init__(self, backend: LRUCache | RedisCache, ttl_s: float = 60):
+        self.backend = backend
+        """Storage of the fragments and generation tokens"""
+        self.ttl_s = ttl_s
+        """Maximum age of a fragment; bounds staleness after changes the cache was not told about"""
+
+    def generation(self, namespace: str) -> str:
+        """The current generation token of `namespace`, a fresh one if it has none (yet, or evicted)"""
+        token = self.backend.get(("generation", namespace))
+        if token is None:
+            token = self.invalidate(namespace)
+        return token
+
+    def invalidate(self, namespace: str, token: Optional[str] = None) -> str:
+        """Drop all fragments of `namespace` by moving it to generation `token` (default: random). Returns the token"""
+        token = token or uuid.uuid4().hex
+        self.backend.set(("generation", namespace), token)
+        return token
+
+    def get(self, namespace: str, key: tuple) -> Optional[str]:
+        """The fragment stored under `key` in the current generation of `namespace`, None if there is none or it expired"""
+        token = self.backend.get(("generation", namespace))
+        if token is None: return None
+        entry = self.backend.get(("fragment", namespace, token, *key))
+        if entry is None: return None
+        expires, fragment = entry
+        return fragment if expires > time.time() else None
+
+    def set(self, namespace: str, key: tuple, fragment: str, generation: Optional[str] = None):
+        """Store a fragment in generation `generation` of `namespace`, default the current one. Pass the generation
+        read before fetching the data the fragment was rendered from: if the namespace was invalidated meanwhile,
+        the outdated fragment is stored unreachably instead of being served"""
+        if generation is None:
+            generation = self.generation(namespace)
+        self.backend.set(("fragment", namespace, generation, *key), (time.time() + self.ttl_s, fragment))
@@ -0,0 +1,190 @@
+"""Export and import of the ELN store as compressed, chunked archives
+
+An archive is a sequence of independently compressed chunks (gzip members, or zstd frames if the optional
+`zstandard` package is installed) of newline delimited JSON. The first line is a header, followed by one line per
+notebook and per deletion:
+
+    {"format": "eln-archive", "format_version": 1, "since_version": 0, "until_version": 1234}
+    {"id": 5, "version": 1201, "created": "...", "notebook": {...}}
+    {"id": 7, "version": 1230, "deleted": true}
+
+Versions are the global write counter of the ELN server, so an export `--since-version` the `until_version` of the
+previous archive only contains what changed since then. Both directions stream in chunks of `chunk_rows` lines,
+memory does not grow with the size of the store.
+
+Usage (on the ELN server's database, see `ELN_DB_PATH`):
+
+    python -m automationserver.eln_archive export backup.eln.gz
+    python -m automationserver.eln_archive export --since-archive backup.eln.gz incremental.eln.gz
+    python -m automationserver.eln_archive import backup.eln.gz
+
+Import into a stopped ELN server (or restart it afterwards), its notebook cache does not see the import."""
+
+import argparse
+import gzip
+import io
+import json
+import sys
+from typing import BinaryIO, Iterator, Literal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from automationserver.eln_server import DB, ELNNotebook, init_db
+from automationserver.sqlite_pool import SQLitePool
+
+
+FORMAT_VERSION = 1
+"Version of the archive layout, stored in the header"
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _compress(data: bytes, compression: Literal["gzip", "zstd"]) -> bytes:
+    """Compress one chunk as a self-contained gzip member / zstd frame"""
+    if compression == "zstd":
+        if zstandard is None: raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _open_lines(archive: BinaryIO) -> Iterator[bytes]:
+    """Iterate the decompressed lines of an archive, whatever its compression"""
+    magic = archive.read(4)
+    archive.seek(0)
+    if magic == _ZSTD_MAGIC:
+        if zstandard is None: raise RuntimeError("zstd archives need the zstandard package")
+        reader = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(archive, read_across_frames=True))
+    else:
+        reader = gzip.GzipFile(fileobj=archive, mode="rb")
+    for line in reader:
+        if line.strip(): yield line
+
+
+def read_header(archive: BinaryIO) -> dict:
+    """Read only the header of an archive"""
+    header = json.loads(next(_open_lines(archive)))
+    if header.get("format") != "eln-archive": raise ValueError("Not an ELN archive")
+    return header
+
+
+def export_archive(out: BinaryIO,
+                   pool: SQLitePool = DB,
+                   since_version: int = 0,
+                   since_id: int = 0,
+                   compression: Literal["gzip", "zstd"] = "gzip",
+                   chunk_rows: int = 1000) -> dict:
+    """Write all notebooks (and deletions) with a version above `since_version` and an ID above `since_id` to `out`
+
+    The export reads one consistent snapshot of the database; writers are not blocked meanwhile (WAL).
+
+    Returns:
+        the archive header, containing the `until_version` to continue from"""
+
+    with pool.connection() as db:
+        db.execute("BEGIN")
+        try:
+            until_version = db.execute("SELECT value FROM eln_counters WHERE name = 'version'").fetchone()[0]
+            header = {"format": "eln-archive", "format_version": FORMAT_VERSION,
+                      "since_version": since_version, "since_id": since_id, "until_version": until_version}
+            chunk = [json.dumps(header)]
+
+            # notebook JSON is embedded as is, without parsing it
+            rows = db.execute("""SELECT '{"id":' || id || ',"version":' || version || ',"created":' || json_quote(created) || ',"notebook":' || json || '}'
+                                 FROM electronic_lab_notes WHERE version > ? AND id > ? ORDER BY version""", (since_version, since_id))
+            deletions = db.execute("""SELECT json_object('id', id, 'version', version, 'deleted', json('true'))
+                                      FROM electronic_lab_notes_deleted WHERE version > ? AND id > ? ORDER BY version""", (since_version, since_id))
+            for cursor in (rows, deletions):
+                while (batch := cursor.fetchmany(chunk_rows)):
+                    chunk += (line for line, in batch)
+                    if len(chunk) >= chunk_rows:
+                        out.write(_compress(("\n".join(chunk) + "\n").encode(), compression))
+                        chunk = []
+            if chunk:
+                out.write(_compress(("\n".join(chunk) + "\n").encode(), compression))
+        finally:
+            db.execute("COMMIT")
+
+    return header
+
+
+def import_archive(archive: BinaryIO, pool: SQLitePool = DB, chunk_rows: int = 1000) -> dict[str, int]:
+    """Apply an archive to the database. Every record is only applied if it is newer than the stored state of its
+    notebook, so archives can be imported repeatedly and in any order. Each chunk is committed on its own
+
+    Returns:
+        counts of `written` notebooks, `deleted` notebooks and `skipped` (outdated) records"""
+
+    lines = _open_lines(archive)
+    header = json.loads(next(lines))
+    if header.get("format") != "eln-archive" or header.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError("Not a supported ELN archive")
+
+    stats = {"written": 0, "deleted": 0, "skipped": 0}
+    chunk = []
+
+    def apply(records: list[dict]):
+        with pool.transaction() as db:
+            for record in records:
+                if record.get("deleted"):
+                    changed = db.execute("DELETE FROM electronic_lab_notes WHERE id = ? AND version < ?", (record["id"], record["version"])).rowcount
+                    db.execute("INSERT OR IGNORE INTO electronic_lab_notes_deleted(version, id) VALUES (?, ?)", (record["version"], record["id"]))
+                    stats["deleted" if changed else "skipped"] += 1
+                else:
+                    nb = ELNNotebook.model_validate(record["notebook"])
+                    # not if the notebook was deleted later on (a tombstone with a higher version exists)
+                    changed = db.execute("""INSERT INTO electronic_lab_notes(id, json, version, created)
+                                            SELECT :id, :json, :version, :created WHERE NOT EXISTS (
+                                                SELECT 1 FROM electronic_lab_notes_deleted WHERE id = :id AND version > :version)
+                                            ON CONFLICT(id) DO UPDATE SET json = excluded.json, version = excluded.version, created = excluded.created
+                                            WHERE excluded.version > electronic_lab_notes.version""",
+                                         {"id": record["id"], "json": nb.model_dump_json(), "version": record["version"], "created": record.get("created")}).rowcount
+                    stats["written" if changed else "skipped"] += 1
+            # versions taken after the import have to be above all imported ones
+            db.execute("UPDATE eln_counters SET value = max(value, ?) WHERE name = 'version'", (max(record["version"] for record in records),))
+
+    for line in lines:
+        chunk.append(json.loads(line))
+        if len(chunk) >= chunk_rows:
+            apply(chunk)
+            chunk = []
+    if chunk: apply(chunk)
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export/import the ELN store as compressed archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write an archive")
+    export_parser.add_argument("archive", help="output file, - for stdout")
+    export_parser.add_argument("--since-version", type=int, default=0, help="only notebooks changed after this version")
+    export_parser.add_argument("--since-archive", help="continue from the until_version of this previous archive")
+    export_parser.add_argument("--since-id", type=int, default=0, help="only notebooks with a higher ID")
+    export_parser.add_argument("--compression", choices=["gzip", "zstd"], default="gzip")
+    export_parser.add_argument("--chunk-rows", type=int, default=1000)
+
+    import_parser = commands.add_parser("import", help="apply an archive")
+    import_parser.add_argument("archive")
+
+    args = parser.parse_args()
+    init_db()
+
+    if args.command == "export":
+        since_version = args.since_version
+        if args.since_archive:
+            with open(args.since_archive, "rb") as previous:
+                since_version = read_header(previous)["until_version"]
+        out = sys.stdout.buffer if args.archive == "-" else open(args.archive, "wb")
+        with out:
+            header = export_archive(out, since_version=since_version, since_id=args.since_id,
+                                    compression=args.compression, chunk_rows=args.chunk_rows)
+        print(f"exported versions {header['since_version']}..{header['until_version']}", file=sys.stderr)
+
+    elif args.command == "import":
+        with open(args.archive, "rb") as archive:
+            stats = import_archive(archive)
+        print(f"imported: {stats}", file=sys.stderr)
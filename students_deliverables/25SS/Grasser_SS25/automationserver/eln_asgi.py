@@ -0,0 +1,147 @@
+"""ASGI serving mode for the ELN server
+
+Serves the same flask routes as `eln_server` through any ASGI server, e.g.
+
+    uvicorn automationserver.eln_asgi:app --host 0.0.0.0 --port 5001
+
+The event loop does all network I/O: it receives request bodies and drains responses to slow clients.
+Only the route itself runs on a bounded thread pool (`ELN_ASGI_THREADS`), so blocking SQLite and pydantic work
+of concurrent requests overlaps without a thread per connection.
+
+Run a single process (no `--workers`): the notebook cache of the ELN server lives in the process."""
+
+import asyncio
+import concurrent.futures
+import os
+import sys
+import tempfile
+from typing import Callable
+
+from automationserver import eln_server
+
+
+THREADS = int(os.environ.get("ELN_ASGI_THREADS", 16))
+"Number of threads running requests"
+
+
+class WSGIThreadPoolAdapter:
+    """Minimal ASGI application wrapping a WSGI application, which runs on a thread pool"""
+
+    def __init__(self, wsgi_app: Callable, max_workers: int):
+        self.wsgi_app = wsgi_app
+        """The wrapped WSGI application"""
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eln-asgi")
+        """The thread pool running the WSGI application"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported scope {scope['type']}")
+
+        # request bodies are small except for file uploads, which are spooled to disk
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message: dict):
+            # blocks the worker thread until the event loop took the message, i.e. backpressure for large responses
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        try:
+            await loop.run_in_executor(self.executor, self._run, scope, body, send_from_thread)
+        finally:
+            body.close()
+
+    def _run(self, scope: dict, body, send: Callable[[dict], None]):
+        """Run the WSGI application for one request, on a worker thread"""
+
+        response_start = {}
+
+        def start_response(status: str, headers: list, exc_info=None):
+            if exc_info and response_start.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start.update(status=int(status.split(" ", 1)[0]),
+                                  headers=[(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers])
+
+        def send_start():
+            if not response_start.get("sent"):
+                send({"type": "http.response.start", "status": response_start["status"], "headers": response_start["headers"]})
+                response_start["sent"] = True
+
+        result = self.wsgi_app(self._environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    send({"type": "http.response.body", "body": chunk, "more_body": True})
+            send_start()
+            send({"type": "http.response.body", "body": b""})
+        finally:
+            # e.g. returns the database connection of a streamed response to the pool
+            if hasattr(result, "close"): result.close()
+
+    @staticmethod
+    def _environ(scope: dict, body) -> dict:
+        """Translate the ASGI scope into a WSGI environ"""
+
+        script_name = scope.get("root_path", "")
+        path_info = scope["path"]
+        if script_name and path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+        server = scope.get("server") or ("localhost", 80)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": script_name.encode("utf8").decode("latin1"),
+            "PATH_INFO": path_info.encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("latin1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin1")
+            key = {"content-length": "CONTENT_LENGTH", "content-type": "CONTENT_TYPE"}.get(name) or "HTTP_" + name.upper().replace("-", "_")
+            value = value.decode("latin1")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _lifespan(self, receive, send):
+        """Migrate the database on startup, close the connections on shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.get_running_loop().run_in_executor(self.executor, eln_server.init_db)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown()
+                eln_server.DB.close_all()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+# every thread may hold a connection at once
+eln_server.DB.max_connections = max(eln_server.DB.max_connections, THREADS)
+
+app = WSGIThreadPoolAdapter(eln_server.app, THREADS)
+"The ASGI application"
@@ -0,0 +1,130 @@
+"""Server-side coalescing of the ELN editor's autosave deltas
+
+Editors send small deltas (see `eln_server.ELNDelta`) over Socket.IO every few seconds. Instead of one ELN write per
+message, deltas are collected per client and notebook and written as one merged delta at most every
+`flush_interval_s`. Writes of one client and notebook are sequential, each on top of the version the previous one
+created (`If-Match`), so a concurrent change by someone else fails the write instead of being overwritten. No delta is
+ever written without such a version: after a failed write, deltas are rejected until the editor saved in full and
+names the resulting version again."""
+
+import threading
+import time
+from typing import Callable, Optional
+
+import flask_socketio
+
+from automationserver.eln_server import ELNDelta
+
+
+class _AutosaveState:
+    """Autosave of one notebook by one client"""
+
+    def __init__(self, user: str):
+        self.user = user
+        """User the writes are made as"""
+        self.etag: Optional[str] = None
+        """Version the pending delta applies to, None while unknown (no delta is accepted then)"""
+        self.pending: Optional[ELNDelta] = None
+        """Merged deltas not written yet"""
+        self.due = 0.0
+        """When the pending delta is written (monotonic time)"""
+        self.running = False
+        """Whether a flush task is active"""
+
+
+class DeltaCoalescer:
+    """Collects autosave deltas per Socket.IO client and notebook, and writes them merged in a background task
+
+    `apply(id, delta, if_match, user)` writes a delta and returns the new ETag; `on_flushed(sid, id, etag, error)` is
+    called after every write, with the exception if it failed. A failed write drops the pending deltas and blocks
+    the autosave: the editor has to save its full content again and pass the new ETag with its next delta."""
+
+    def __init__(self,
+                 socketio: flask_socketio.SocketIO,
+                 apply: Callable[[int, ELNDelta, Optional[str], str], Optional[str]],
+                 on_flushed: Callable[[str, int, Optional[str], Optional[Exception]], None],
+                 flush_interval_s: float = 1.0):
+        self.socketio = socketio
+        """The Socket.IO server running the flush tasks"""
+        self.apply = apply
+        """Writes a delta to the ELN"""
+        self.on_flushed = on_flushed
+        """Notified after each write"""
+        self.flush_interval_s = flush_interval_s
+        """Time deltas are collected before they are written"""
+
+        self._states: dict[tuple[str, int], _AutosaveState] = {}
+        self._lock = threading.Lock()
+
+    def add(self, sid: str, id: int, delta: ELNDelta, user: str, etag: Optional[str] = None, flush: bool = False) -> bool:
+        """Queue `delta` of client `sid` for notebook `id`. `etag` is the version the editor's content is based on, only
+        needed for the first delta after a full save - later deltas chain onto the previous writes.
+        `flush` writes the queued deltas without waiting for the flush interval.
+
+        Returns False (and drops the delta) if the version it applies to is unknown: no `etag` was passed for a new
+        autosave, or after a failed write"""
+        key = (sid, id)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or state.user != user:
+                state = self._states[key] = _AutosaveState(user)
+            if etag is not None:
+                # a full save moved the notebook to a new version, deltas still queued for an older one are void
+                if state.pending is not None and etag != state.etag: state.pending = None
+                state.etag = etag
+            if state.etag is None: return False
+
+            if state.pending is None:
+                state.pending = delta.model_copy(deep=True)
+                state.due = time.monotonic() + self.flush_interval_s
+            else:
+                # splices apply in order, so they concatenate; title and visibility are set by the latest delta
+                state.pending.splices.extend(delta.splices)
+                state.pending.length = delta.length
+                if delta.title is not None: state.pending.title = delta.title
+                if delta.public is not None: state.pending.public = delta.public
+            if flush: state.due = time.monotonic()
+
+            if state.running: return True
+            state.running = True
+        self.socketio.start_background_task(self._run, key, state)
+        return True
+
+    def discard(self, sid: str):
+        """Forget all autosaves of client `sid` (e.g. on disconnect), after writing their pending deltas"""
+        with self._lock:
+            for key, state in list(self._states.items()):
+                if key[0] != sid: continue
+                # a running flush task keeps its state and writes what is pending
+                state.due = time.monotonic()
+                del self._states[key]
+
+    def _run(self, key: tuple[str, int], state: _AutosaveState):
+        """The flush task: write the pending delta once due, until nothing is pending"""
+        sid, id = key
+        while True:
+            with self._lock:
+                if state.pending is None:
+                    # the state stays, so the next delta chains onto the ETag of this write
+                    state.running = False
+                    return
+                delay = state.due - time.monotonic()
+                if delay <= 0:
+                    delta, state.pending = state.pending, None
+            if delay > 0:
+                self.socketio.sleep(delay)
+                continue
+
+            try:
+                etag, error = self.apply(id, delta, state.etag, state.user), None
+            except Exception as e:
+                etag, error = None, e
+            with self._lock:
+                if error is None and etag:
+                    state.etag = etag
+                else:
+                    # later deltas build on the failed one, so they are dropped, too; with the version unknown,
+                    # further deltas are rejected until the editor saved in full
+                    state.pending = None
+                    state.etag = None
+            self.on_flushed(sid, id, etag, error)
@@ -0,0 +1,100 @@
+"""Client for the REST API of the ELN server, as used by the frontend
+
+All calls share one `requests.Session`, i.e. a pool of keep-alive connections to the ELN server, instead of opening a
+TCP connection per call. Every call has a timeout, idempotent calls are retried on connection problems and 502-504,
+and the latency of every call is traced per operation (span `http.client`, see `tracing`). Calls carry the ID of the
+request they are made for, so they can be correlated with the ELN server's side."""
+
+import time
+from typing import Optional
+
+import requests
+import requests.adapters
+import urllib3.util
+
+from automationserver import tracing
+from automationserver.eln_server import ELNNotebook
+
+
+class ELNError(Exception):
+    """A call to the ELN server failed. `status_code` is the ELN server's status, or 502/504 if it could not be reached"""
+
+    def __init__(self, status_code: int, message: str = ""):
+        super().__init__(f"ELN server: {status_code} {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class ELNClient:
+    """Connection pooled client of the ELN server's API"""
+
+    def __init__(self, endpoint: str, timeout: tuple[float, float] = (3.05, 30), retries: int = 3, pool_maxsize: int = 32):
+        self.endpoint = endpoint
+        """Base URL of the API, ending in `/`"""
+        self.timeout = timeout
+        """Connect and read timeout per call in seconds"""
+
+        retry = urllib3.util.Retry(total=retries, backoff_factor=0.1, status_forcelist=[502, 503, 504],
+                                   allowed_methods=["GET", "HEAD", "DELETE"], raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        """Shared session, keeping up to `pool_maxsize` connections alive"""
+        self.session.mount(endpoint, adapter)
+
+    def _request(self, operation: str, method: str, path: str = "", **kwargs) -> requests.Response:
+        """Issue a call and trace its latency under `operation`. Raises `ELNError` for error responses"""
+        if (request_id := tracing.request_id()):
+            kwargs["headers"] = {**kwargs.get("headers", {}), tracing.REQUEST_ID_HEADER: request_id}
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, self.endpoint + path, timeout=self.timeout, **kwargs)
+            status = response.status_code
+        except requests.Timeout as e:
+            raise ELNError(504, str(e))
+        except requests.ConnectionError as e:
+            raise ELNError(502, str(e))
+        finally:
+            tracing.observe("http.client", time.perf_counter() - start, operation=operation, status=status)
+
+        if response.status_code >= 400:
+            raise ELNError(response.status_code if response.status_code < 500 else 502, response.reason)
+        return response
+
+    def get_notebook(self, id: int) -> tuple[ELNNotebook, Optional[str]]:
+        """Retrieve notebook `id` together with its ETag (identifying the version)"""
+        response = self._request("get_notebook", "GET", f"{id}")
+        return ELNNotebook.model_validate_json(response.content), response.headers.get("ETag")
+
+    def create_notebook(self, nb: ELNNotebook) -> int:
+        """Store a new notebook, returns its ID"""
+        return self._request("create_notebook", "PUT", json=nb.model_dump(mode="json")).json()["id"]
+
+    @staticmethod
+    def _write_headers(user: Optional[str], if_match: Optional[str]) -> dict[str, str]:
+        """Headers restricting a write to notebooks `user` may edit, at version `if_match`"""
+        headers = {"X-ELN-User": user} if user else {}
+        if if_match: headers["If-Match"] = if_match
+        return headers
+
+    def patch_notebook(self, id: int, changes: dict, if_match: Optional[str] = None, user: Optional[str] = None) -> Optional[str]:
+        """Change fields of notebook `id`, only if it is still at version `if_match` and `user` may edit it (if given).
+        Returns the new ETag"""
+        return self._request("patch_notebook", "PATCH", f"{id}", json=changes, headers=self._write_headers(user, if_match)).headers.get("ETag")
+
+    def apply_delta(self, id: int, delta: dict, if_match: Optional[str] = None, user: Optional[str] = None) -> Optional[str]:
+        """Apply an incremental change (see `eln_server.ELNDelta`) to notebook `id`, only if it is still at version
+        `if_match` and `user` may edit it (if given). Returns the new ETag"""
+        return self._request("apply_delta", "POST", f"{id}/delta", json=delta, headers=self._write_headers(user, if_match)).headers.get("ETag")
+
+    def delete_notebook(self, id: int, if_match: Optional[str] = None, user: Optional[str] = None):
+        """Delete notebook `id`, only if it is still at version `if_match` and `user` may edit it (if given)"""
+        self._request("delete_notebook", "DELETE", f"{id}", headers=self._write_headers(user, if_match))
+
+    def query(self, payload: dict) -> dict:
+        """Query notebooks, see `eln_server.QueryModel` for the payload. Returns one page of results"""
+        return self._request("query", "POST", "query", json=payload).json()
+
+    def tag_facets(self, user: Optional[str]) -> list[dict]:
+        """Number of notebooks visible to `user` per tag"""
+        return self._request("tag_facets", "POST", "tags", json={"user": user}).json()
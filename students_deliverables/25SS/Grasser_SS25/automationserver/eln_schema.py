@@ -0,0 +1,175 @@
+"""Database scheme of the ELN server and its migrations
+
+The scheme version is tracked in `PRAGMA user_version`. Every entry of `MIGRATIONS` brings the database from
+version `i` to `i + 1`, so existing `eln_db.sqlite` files are upgraded in place on server start."""
+
+import html
+import re
+import sqlite3
+
+
+_TAG_RE = re.compile(r"<[^>]*>")
+
+def strip_html(markup: str | None) -> str:
+    """Reduce the HTML body of a notebook to its text, so the search index matches neither markup nor attributes"""
+    if not markup: return ""
+    return html.unescape(_TAG_RE.sub(" ", markup))
+
+
+def register_functions(db: sqlite3.Connection):
+    """Register the SQL functions used by the triggers. Needs to run on every connection that writes notebooks"""
+    db.create_function("strip_html", 1, strip_html, deterministic=True)
+
+
+MIGRATIONS: list[str] = [
+    # 1: the original table
+    """
+    CREATE TABLE IF NOT EXISTS electronic_lab_notes(id INTEGER PRIMARY KEY, json TEXT);
+    """,
+
+    # 2: full text index over title, text content and tags, kept in sync by triggers
+    """
+    CREATE VIRTUAL TABLE electronic_lab_notes_fts USING fts5(title, content, tags, tokenize='unicode61 remove_diacritics 2');
+
+    CREATE TRIGGER electronic_lab_notes_fts_insert AFTER INSERT ON electronic_lab_notes BEGIN
+        INSERT INTO electronic_lab_notes_fts(rowid, title, content, tags) VALUES (
+            new.id,
+            json_extract(new.json, '$.title'),
+            strip_html(json_extract(new.json, '$.content')),
+            (SELECT group_concat(value, ' ') FROM json_each(new.json, '$.tags')));
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_fts_delete AFTER DELETE ON electronic_lab_notes BEGIN
+        DELETE FROM electronic_lab_notes_fts WHERE rowid = old.id;
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_fts_update AFTER UPDATE OF json ON electronic_lab_notes BEGIN
+        DELETE FROM electronic_lab_notes_fts WHERE rowid = old.id;
+        INSERT INTO electronic_lab_notes_fts(rowid, title, content, tags) VALUES (
+            new.id,
+            json_extract(new.json, '$.title'),
+            strip_html(json_extract(new.json, '$.content')),
+            (SELECT group_concat(value, ' ') FROM json_each(new.json, '$.tags')));
+    END;
+
+    INSERT INTO electronic_lab_notes_fts(rowid, title, content, tags)
+        SELECT id,
+               json_extract(json, '$.title'),
+               strip_html(json_extract(json, '$.content')),
+               (SELECT group_concat(value, ' ') FROM json_each(electronic_lab_notes.json, '$.tags'))
+        FROM electronic_lab_notes;
+    """,
+
+    # 3: promote the fields used for filtering to indexed columns. Generated columns can only be added as
+    # VIRTUAL, which is fine: only the indexes store them. `created` is not part of the JSON and set on insert
+    """
+    ALTER TABLE electronic_lab_notes ADD COLUMN creator TEXT GENERATED ALWAYS AS (json_extract(json, '$.creator')) VIRTUAL;
+    ALTER TABLE electronic_lab_notes ADD COLUMN public INTEGER GENERATED ALWAYS AS (json_extract(json, '$.public')) VIRTUAL;
+    ALTER TABLE electronic_lab_notes ADD COLUMN title TEXT GENERATED ALWAYS AS (json_extract(json, '$.title')) VIRTUAL;
+    ALTER TABLE electronic_lab_notes ADD COLUMN created TEXT;
+
+    UPDATE electronic_lab_notes SET created = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE created IS NULL;
+
+    CREATE INDEX electronic_lab_notes_creator ON electronic_lab_notes(creator);
+    CREATE INDEX electronic_lab_notes_public ON electronic_lab_notes(public);
+    CREATE INDEX electronic_lab_notes_title ON electronic_lab_notes(title);
+    CREATE INDEX electronic_lab_notes_created ON electronic_lab_notes(created);
+    """,
+
+    # 4: versions. Every write takes the next value of a global counter, so a version identifies one state
+    # of one notebook even if SQLite reuses the ID of a deleted row
+    """
+    CREATE TABLE eln_counters(name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    INSERT INTO eln_counters(name, value) VALUES ('version', (SELECT coalesce(max(id), 0) FROM electronic_lab_notes));
+
+    ALTER TABLE electronic_lab_notes ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+    UPDATE electronic_lab_notes SET version = id;
+    CREATE INDEX electronic_lab_notes_version ON electronic_lab_notes(version);
+    """,
+
+    # 5: normalized tags, maintained by triggers. `public` and `creator` are copied from the notebook,
+    # so tag filters and facet counts restricted to visible notebooks never touch the notebook rows
+    """
+    CREATE TABLE electronic_lab_notes_tags(
+        tag TEXT NOT NULL,
+        notebook_id INTEGER NOT NULL,
+        public INTEGER,
+        creator TEXT,
+        PRIMARY KEY (tag, notebook_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX electronic_lab_notes_tags_notebook ON electronic_lab_notes_tags(notebook_id);
+    CREATE INDEX electronic_lab_notes_tags_public ON electronic_lab_notes_tags(public, tag);
+    CREATE INDEX electronic_lab_notes_tags_creator ON electronic_lab_notes_tags(creator, tag);
+
+    CREATE TRIGGER electronic_lab_notes_tags_insert AFTER INSERT ON electronic_lab_notes BEGIN
+        INSERT OR IGNORE INTO electronic_lab_notes_tags(tag, notebook_id, public, creator)
+            SELECT value, new.id, new.public, new.creator FROM json_each(new.json, '$.tags');
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_tags_delete AFTER DELETE ON electronic_lab_notes BEGIN
+        DELETE FROM electronic_lab_notes_tags WHERE notebook_id = old.id;
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_tags_update AFTER UPDATE OF json ON electronic_lab_notes
+    WHEN json_extract(old.json, '$.tags') IS NOT json_extract(new.json, '$.tags') OR old.public IS NOT new.public OR old.creator IS NOT new.creator
+    BEGIN
+        DELETE FROM electronic_lab_notes_tags WHERE notebook_id = old.id;
+        INSERT OR IGNORE INTO electronic_lab_notes_tags(tag, notebook_id, public, creator)
+            SELECT value, new.id, new.public, new.creator FROM json_each(new.json, '$.tags');
+    END;
+
+    INSERT OR IGNORE INTO electronic_lab_notes_tags(tag, notebook_id, public, creator)
+        SELECT t.value, n.id, n.public, n.creator FROM electronic_lab_notes AS n, json_each(n.json, '$.tags') AS t;
+    """,
+
+    # 6: tombstones of deleted notebooks with the version of their deletion, for incremental exports
+    """
+    CREATE TABLE electronic_lab_notes_deleted(version INTEGER PRIMARY KEY, id INTEGER NOT NULL);
+    """,
+
+    # 7: references of the notebooks to their attached files, maintained by triggers. A file whose last reference
+    # is removed is queued as orphaned; the server deletes its blob once it is still unreferenced after the write
+    """
+    CREATE TABLE electronic_lab_notes_files(
+        digest TEXT NOT NULL,
+        notebook_id INTEGER NOT NULL,
+        PRIMARY KEY (digest, notebook_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX electronic_lab_notes_files_notebook ON electronic_lab_notes_files(notebook_id);
+    CREATE TABLE electronic_lab_notes_orphaned_files(digest TEXT PRIMARY KEY) WITHOUT ROWID;
+
+    CREATE TRIGGER electronic_lab_notes_files_insert AFTER INSERT ON electronic_lab_notes BEGIN
+        INSERT OR IGNORE INTO electronic_lab_notes_files(digest, notebook_id)
+            SELECT json_extract(value, '$.uuid'), new.id FROM json_each(new.json, '$.files');
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_files_delete AFTER DELETE ON electronic_lab_notes BEGIN
+        DELETE FROM electronic_lab_notes_files WHERE notebook_id = old.id;
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_files_update AFTER UPDATE OF json ON electronic_lab_notes
+    WHEN json_extract(old.json, '$.files') IS NOT json_extract(new.json, '$.files')
+    BEGIN
+        DELETE FROM electronic_lab_notes_files WHERE notebook_id = old.id;
+        INSERT OR IGNORE INTO electronic_lab_notes_files(digest, notebook_id)
+            SELECT json_extract(value, '$.uuid'), new.id FROM json_each(new.json, '$.files');
+    END;
+
+    CREATE TRIGGER electronic_lab_notes_files_orphaned AFTER DELETE ON electronic_lab_notes_files
+    WHEN NOT EXISTS (SELECT 1 FROM electronic_lab_notes_files WHERE digest = old.digest)
+    BEGIN
+        INSERT OR IGNORE INTO electronic_lab_notes_orphaned_files(digest) VALUES (old.digest);
+    END;
+
+    INSERT OR IGNORE INTO electronic_lab_notes_files(digest, notebook_id)
+        SELECT json_extract(f.value, '$.uuid'), n.id FROM electronic_lab_notes AS n, json_each(n.json, '$.files') AS f;
+    """,
+]
+
+
+def migrate(db: sqlite3.Connection):
+    """Apply all pending migrations, each in its own transaction"""
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        # executescript() does not take parameters; the version is an int we control
+        db.executescript(f"BEGIN IMMEDIATE; {script}; PRAGMA user_version = {target}; COMMIT;")
@@ -1,24 +1,59 @@
 """Basic CRUD application handling electronic lab notebook entries
 
 Designed to run as seperate application from the frontend, not accessible from outside but only inside the container network.
-By this token, user authentication and privilege management is handled by the frontend."""
+By this token, user authentication and privilege management is handled by the frontend. The frontend names the acting user
+in the `X-ELN-User` header of writes (and file downloads), which are then only applied to notebooks the user may edit
+(own or public)."""
 
 
 import pydantic
 import flask
 from flask.views import MethodView
 import datetime
-from typing import Literal
+from typing import Annotated, Literal, NamedTuple
 import sqlite3
 import pathlib
 from typing import Optional
 import json
+import os
+import re
+from automationserver.sqlite_pool import PoolTimeout, SQLitePool
+from automationserver import eln_schema
+from automationserver.cache import LRUCache
+from automationserver.file_store import ContentStore
+from automationserver import tracing
 
 
 
+# Database configuration
+
+DB_PATH = pathlib.Path(db_path) if (db_path := os.environ.get("ELN_DB_PATH")) else pathlib.Path(__file__).parent / "store" / "eln_db.sqlite"
+"Location of the notebook database; defaults to the bundled store, can be overridden by the environment"
+
+DB_CHECKOUT_TIMEOUT_S = float(os.environ.get("ELN_DB_CHECKOUT_TIMEOUT_S", 10))
+"How long a request waits for a database connection while all are in use, before it is answered with a 503"
+
+DB = SQLitePool(DB_PATH, checkout_timeout_s=DB_CHECKOUT_TIMEOUT_S, on_connect=eln_schema.register_functions)
+"Connection pool shared by every route. Connections are opened lazily on first use"
+
+FILE_STORE = ContentStore(pathlib.Path(file_store) if (file_store := os.environ.get("ELN_FILE_STORE")) else DB_PATH.parent / "blobs")
+"Content addressed storage of the files attached to notebooks"
+
+def init_db(pool: SQLitePool = DB):
+    """Create or migrate the database scheme, if necessary"""
+    with pool.connection() as db:
+        eln_schema.migrate(db)
+
+
 # Model definitions
 
 app = flask.Flask(__file__)
+tracing.instrument_app(app)
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e: PoolTimeout):
+    """All database connections stayed in use: the server is overloaded, the client may retry later"""
+    return str(e), 503, {"Retry-After": "1"}
 
 class ELNFile(pydantic.BaseModel):
     """Basic Metadata needed to be contained in every ELN data section"""
@@ -29,7 +64,9 @@ class ELNFile(pydantic.BaseModel):
     name: str
     """filename as uploaded"""
     uuid: str
-    """UUID used as filename"""
+    """UUID used as filename; the SHA-256 digest of the content for files stored in `FILE_STORE`"""
+    size: Optional[int] = None
+    """Size in bytes"""
 
 
 class ELNNotebook(pydantic.BaseModel):
@@ -49,6 +86,165 @@ class ELNNotebook(pydantic.BaseModel):
     """Uploaded files attached to the notebook"""
 
 
+class ELNNotebookPatch(pydantic.BaseModel):
+    """Partial `ELNNotebook` for updates. Only the fields present in the JSON are changed, lists are replaced as a whole"""
+
+    creator: Optional[str] = None
+    public: Optional[bool] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+    tags: Optional[list[str]] = None
+    files: Optional[list[ELNFile]] = None
+
+    @pydantic.model_validator(mode="after")
+    def _check_not_null(self):
+        """Fields may be left out, but not set to null - as merge patch, null would delete them from the notebook"""
+        for field in self.model_fields_set:
+            if getattr(self, field) is None: raise ValueError(f"{field} may not be null")
+        return self
+
+
+
+# Database access, shared by the single entry API and the batch API
+
+class CachedNotebook(NamedTuple):
+    """A notebook in the state of one `version`, as held by `NOTEBOOK_CACHE`"""
+    version: int
+    """Version of the stored row; unique over all notebooks and increasing with every write"""
+    notebook: Optional[ELNNotebook]
+    """The validated notebook, None if it was deleted in this version"""
+    body: Optional[str]
+    """The notebook serialized as JSON, ready to be sent"""
+
+NOTEBOOK_CACHE = LRUCache(int(os.environ.get("ELN_CACHE_SIZE", 1024)))
+"""Validated notebooks by ID. Writes store their result here, so the cache is only coherent as long as
+every write goes through this process (the ELN server runs as a single process)"""
+
+def _cache_store(id: int, entry: CachedNotebook):
+    """Cache `entry` unless a newer version is cached already (a read may race with a write and finish last).
+    Call only after the write is committed"""
+    NOTEBOOK_CACHE.set_if(id, entry, lambda cached: cached.version < entry.version)
+
+def _next_version(db: sqlite3.Connection) -> int:
+    """Take the next value of the global version counter. Must run in the transaction of the write"""
+    return db.execute("UPDATE eln_counters SET value = value + 1 WHERE name = 'version' RETURNING value").fetchone()[0]
+
+def _insert_notebook(db: sqlite3.Connection, nb: ELNNotebook) -> tuple[int, CachedNotebook]:
+    """Insert a validated notebook, returns its new ID and cache entry"""
+    version = _next_version(db)
+    body = nb.model_dump_json()
+    cursor = db.execute("INSERT INTO electronic_lab_notes(json, version, created) VALUES (?, ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))",
+                        (body, version))
+    return cursor.lastrowid, CachedNotebook(version, nb, body)
+
+def _update_notebook(db: sqlite3.Connection, id: int, nb: ELNNotebook) -> Optional[CachedNotebook]:
+    """Replace the stored notebook `id` with the validated `nb`, returns the new cache entry (None if `id` does not exist)"""
+    version = _next_version(db)
+    body = nb.model_dump_json()
+    if db.execute("UPDATE electronic_lab_notes SET json=?, version=? WHERE id = ?", (body, version, id)).rowcount == 0:
+        return None
+    return CachedNotebook(version, nb, body)
+
+# conditions of conditional writes: the `If-Match` versions and the acting user's permission, each skipped if NULL
+_WRITE_CONDITIONS_SQL = """(:if_versions IS NULL OR version IN (SELECT value FROM json_each(:if_versions)))
+                           AND (:user IS NULL OR creator = :user OR public = 1)"""
+
+def _patch_notebook(db: sqlite3.Connection, id: int, patch: ELNNotebookPatch, if_versions: Optional[list[int]] = None,
+                    user: Optional[str] = None) -> Optional[CachedNotebook]:
+    """Apply `patch` to the stored notebook `id` as JSON merge patch within SQLite, without reading it first.
+
+    If `if_versions` is given, the notebook is only changed if its current version is one of them.
+    If `user` is given, it is only changed if the user may edit it (own or public notebook).
+
+    Returns:
+        the new cache entry, None if no notebook matched (unknown `id`, other version or no permission)"""
+
+    version = _next_version(db)
+    fetchres = db.execute(f"""UPDATE electronic_lab_notes SET json = json_patch(json, :patch), version = :version
+                              WHERE id = :id AND {_WRITE_CONDITIONS_SQL}
+                              RETURNING json""",
+                          {"patch": patch.model_dump_json(exclude_unset=True), "version": version, "id": id, "user": user,
+                           "if_versions": None if if_versions is None else json.dumps(if_versions)}).fetchone()
+    if not fetchres: return None
+    with tracing.span("validate", model="ELNNotebook"):
+        nb = ELNNotebook.model_validate_json(fetchres[0])
+    return CachedNotebook(version, nb, fetchres[0])
+
+def _delete_notebook(db: sqlite3.Connection, id: int, if_versions: Optional[list[int]] = None,
+                     user: Optional[str] = None) -> Optional[CachedNotebook]:
+    """Delete notebook `id` (if its version is one of `if_versions` and `user` may edit it, if given).
+    Returns the cache entry marking it deleted, None if no notebook matched"""
+    if db.execute(f"DELETE FROM electronic_lab_notes WHERE id = :id AND {_WRITE_CONDITIONS_SQL}",
+                  {"id": id, "user": user, "if_versions": None if if_versions is None else json.dumps(if_versions)}).rowcount == 0:
+        return None
+    version = _next_version(db)
+    db.execute("INSERT INTO electronic_lab_notes_deleted(version, id) VALUES (?, ?)", (version, id))
+    return CachedNotebook(version, None, None)
+
+def _if_match_versions() -> Optional[list[int]]:
+    """The versions accepted by the request's `If-Match` header, None if any version is (no header or `*`)"""
+    if_match = flask.request.if_match
+    if not if_match or if_match.star_tag: return None
+    # only strong tags count for If-Match; anything that is not one of our versions can never match
+    return [int(tag) for tag in if_match if tag.isdigit()]
+
+def _acting_user() -> Optional[str]:
+    """The user named in the request's `X-ELN-User` header, None for unrestricted access"""
+    return flask.request.headers.get("X-ELN-User") or None
+
+def _unmatched_status(db: sqlite3.Connection, id: int, user: Optional[str] = None) -> int:
+    """After a conditional write matched no row: 404 if notebook `id` does not exist, 401 if `user` may not edit it,
+    412 if it has another version. Only runs on the failure path, successful writes take a single statement"""
+    fetchres = db.execute("SELECT creator, public FROM electronic_lab_notes WHERE id = ?", (id,)).fetchone()
+    if not fetchres: return 404
+    creator, public = fetchres
+    if user is not None and not (creator == user or public): return 401
+    return 412
+
+def _abort_unmatched(db: sqlite3.Connection, id: int, user: Optional[str] = None):
+    """Abort with the reason a conditional write on notebook `id` matched no row, see `_unmatched_status`"""
+    status = _unmatched_status(db, id, user)
+    if status == 401: flask.abort(401, "Unauthorized for notebook action")
+    if status == 412: flask.abort(412, "The notebook was changed in the meantime")
+    flask.abort(404, "The requested resource was not found")
+
+def _check_access(nb: ELNNotebook, user: Optional[str]):
+    """Raise a 401 unless `user` may access `nb` (own or public notebook); None is unrestricted access"""
+    if user is not None and not (nb.creator == user or nb.public):
+        flask.abort(401, "Unauthorized for notebook action")
+
+def _collect_orphaned_files():
+    """Delete the blobs of files that lost their last reference (queued by the triggers of `eln_schema`), unless they
+    are referenced again. Call after the write that may have orphaned them.
+
+    Runs in a write transaction of its own: uploads store their blob in their write transaction, too, so an upload of
+    the same content either comes first (and its reference keeps the blob) or after (and stores the blob again)"""
+    with DB.connection() as db:
+        if not db.execute("SELECT 1 FROM electronic_lab_notes_orphaned_files LIMIT 1").fetchone(): return
+    with DB.transaction() as db:
+        for digest, in db.execute("DELETE FROM electronic_lab_notes_orphaned_files RETURNING digest").fetchall():
+            if db.execute("SELECT 1 FROM electronic_lab_notes_files WHERE digest = ?", (digest,)).fetchone(): continue
+            try:
+                FILE_STORE.delete(digest)
+            except ValueError:
+                pass  # a UUID from before the content store, not a blob of `FILE_STORE`
+
+def _load_notebook(id: int) -> CachedNotebook:
+    """Get notebook `id` from the cache, or from the database and cache it. Raises a 404 if it does not exist"""
+    entry = NOTEBOOK_CACHE.get(id)
+    if entry is None:
+        with DB.connection() as db:
+            fetchres = db.execute("SELECT json, version FROM electronic_lab_notes WHERE id = ?", (id,)).fetchone()
+        if not fetchres: flask.abort(404, "The requested resource was not found")
+        body, version = fetchres
+        with tracing.span("validate", model="ELNNotebook"):
+            nb = ELNNotebook.model_validate_json(body)
+        entry = CachedNotebook(version, nb, body)
+        _cache_store(id, entry)
+
+    if entry.notebook is None: flask.abort(404, "The requested resource was not found")
+    return entry
+
 
 # Define APIs and Routes
 
@@ -56,26 +252,33 @@ class API_ELN(MethodView):
     """CRUD implementation of a single ELN entry. `ELNData` entries have no seperate API, but are necessarily always connected
     to their containing `ELNNotebook` entry
     
-    Supports `PUT`, `GET`, `DELETE`, `PATCH` (and implicitly `OPTIONS`)"""
+    Supports `PUT`, `GET`, `DELETE`, `PATCH` (and implicitly `OPTIONS`)
+    
+    Responses carry the notebook's version as `ETag`, `GET` answers a matching `If-None-Match` with a 304.
+    `PATCH` and `DELETE` honour `If-Match` and fail with a 412 if the notebook was changed in the meantime.
+    With an `X-ELN-User` header they fail with a 401 unless the notebook is the user's own or public"""
     
     init_every_request = False
 
     def get(self, id):
-        """Retrieve ELN entry with `id` as dict or JSON if view
+        """Retrieve ELN entry with `id` as JSON. Served from `NOTEBOOK_CACHE` if possible
         
         Returns:
-            the JSON of the fetched entry (or a 404)"""
+            the JSON of the fetched entry (or a 404, or a 304 if it matches `If-None-Match`)"""
         
-        db = sqlite3.connect(DB_PATH, autocommit=True)
-        cursor = db.cursor()
-        cursor.execute("SELECT json FROM electronic_lab_notes WHERE id = ?", (id,))
-        
-        fetchres = cursor.fetchone()
-        cursor.close()
-        db.close()
-        if not fetchres: flask.abort(404, "The requested resource was not found")
-        nb = ELNNotebook.model_validate_json(fetchres[0])
-        return nb.model_dump()
+        if flask.request.if_none_match and NOTEBOOK_CACHE.get(id) is None:
+            # conditional request for an uncached notebook - compare the version before paying for validation
+            with DB.connection() as db:
+                fetchres = db.execute("SELECT version FROM electronic_lab_notes WHERE id = ?", (id,)).fetchone()
+            if fetchres and flask.request.if_none_match.contains(str(fetchres[0])):
+                response = flask.make_response("", 304)
+                response.set_etag(str(fetchres[0]))
+                return response
+
+        entry = _load_notebook(id)
+        response = flask.Response(entry.body, mimetype="application/json")
+        response.set_etag(str(entry.version))
+        return response.make_conditional(flask.request)
     
     def put(self, id="new"):
         """Create a new ELN entry. An ID is not necessary and will be ignored (one will be assigned automatically)
@@ -86,45 +289,54 @@ class API_ELN(MethodView):
         print("PUT request for ID")
         json_data = flask.request.json
         try:
-            validated = ELNNotebook.model_validate(json_data)
+            with tracing.span("validate", model="ELNNotebook"):
+                validated = ELNNotebook.model_validate(json_data)
         except pydantic.ValidationError:
             flask.abort(415, "JSON did not pass validation")
 
-        db = sqlite3.connect(DB_PATH, autocommit=True)
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO electronic_lab_notes(json) VALUES (?)",
-                       (validated.model_dump_json(),))
-        cursor.close()
-        db.close()
+        with DB.transaction() as db:
+            id, entry = _insert_notebook(db, validated)
+        _cache_store(id, entry)
 
-        return {"id":cursor.lastrowid}
+        response = flask.jsonify({"id":id})
+        response.set_etag(str(entry.version))
+        return response
     
     def patch(self, id):
-        """"Update the existing ELN entry with `<id>`. Allows partial JSONs of the ELN Notebook"""
+        """"Update the existing ELN entry with `<id>`. Allows partial JSONs of the ELN Notebook (see `ELNNotebookPatch`),
+        only the given fields are written
         
-        old_model:dict = self.get(id)
-        print("old", old_model)
-        json_data = flask.request.json
-        print("json", json_data)
-        new_model = ELNNotebook.model_validate(dict(old_model, **json_data))
-
-        db = sqlite3.connect(DB_PATH, autocommit=True)
-        cursor = db.cursor()
-        cursor.execute("UPDATE electronic_lab_notes SET json=? WHERE id = ?", (new_model.model_dump_json(), id))
-        cursor.close()
-        db.close()
+        Returns:
+            the JSON of the updated entry"""
         
-        return new_model.model_dump()
+        try:
+            with tracing.span("validate", model="ELNNotebookPatch"):
+                patch = ELNNotebookPatch.model_validate(flask.request.json)
+        except pydantic.ValidationError:
+            flask.abort(415, "JSON did not pass validation")
+
+        user = _acting_user()
+        with DB.transaction() as db:
+            entry = _patch_notebook(db, id, patch, _if_match_versions(), user)
+            if entry is None: _abort_unmatched(db, id, user)
+        _cache_store(id, entry)
+        if patch.files is not None: _collect_orphaned_files()
+
+        response = flask.Response(entry.body, mimetype="application/json")
+        response.set_etag(str(entry.version))
+        return response
     
 
     def delete(self, id):
         """Delete ELN item with `<id>`"""
 
-        db = sqlite3.connect(DB_PATH, autocommit=True)
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM electronic_lab_notes WHERE id = ?", (id,))
-        cursor.close()
-        db.close()
+        user = _acting_user()
+        with DB.transaction() as db:
+            tombstone = _delete_notebook(db, id, _if_match_versions(), user)
+            if tombstone is None and (flask.request.if_match or user): _abort_unmatched(db, id, user)
+        if tombstone:
+            _cache_store(id, tombstone)
+            _collect_orphaned_files()
 
         response = flask.make_response()
         response.status_code = 200
@@ -133,50 +345,440 @@ class API_ELN(MethodView):
 app.add_url_rule("/api/", view_func=API_ELN.as_view("API_ELN_PUT"))
 app.add_url_rule("/api/<int:id>", view_func=API_ELN.as_view("API_ELN"))
 
+@app.route("/api/<int:id>/files", methods=["PUT"])
+def put_file_eln(id):
+    """Upload a file and attach it to notebook `id`. The request body is the raw file content, streamed to `FILE_STORE`
+
+    Query arguments:
+        name: the filename as uploaded
+        creator: the uploading user's ID
+    Returns:
+        The JSON of the new `ELNFile`, 201 (401 if the `X-ELN-User` may not edit the notebook)"""
+
+    name, creator = flask.request.args.get("name"), flask.request.args.get("creator")
+    if not (name and creator): flask.abort(400, "name and creator are required")
+    user = _acting_user()
+    _check_access(_load_notebook(id).notebook, user)  # 404 or 401 before storing anything
+
+    staged = FILE_STORE.stage(flask.request.stream)
+    try:
+        eln_file = ELNFile(creator=creator, timestamp=datetime.datetime.now(datetime.timezone.utc), name=name,
+                           uuid=staged.digest, size=staged.size)
+        with DB.transaction() as db:
+            fetchres = db.execute("SELECT json FROM electronic_lab_notes WHERE id = ?", (id,)).fetchone()
+            if not fetchres: flask.abort(404, "The requested resource was not found")
+            with tracing.span("validate", model="ELNNotebook"):
+                nb = ELNNotebook.model_validate_json(fetchres[0])
+            _check_access(nb, user)
+            nb.files.append(eln_file)
+            entry = _update_notebook(db, id, nb)
+            # stored under the write lock, see `_collect_orphaned_files`
+            FILE_STORE.commit(staged)
+    finally:
+        FILE_STORE.discard(staged)
+    _cache_store(id, entry)
+
+    return eln_file.model_dump(mode="json"), 201
+
+def _find_file(nb: ELNNotebook, uuid: str) -> ELNFile:
+    """The file `uuid` attached to `nb`, raises a 404 if there is none"""
+    for eln_file in nb.files:
+        if eln_file.uuid == uuid: return eln_file
+    flask.abort(404, "The requested resource was not found")
+
+@app.route("/api/<int:id>/files/<uuid>", methods=["GET"])
+def get_file_eln(id, uuid):
+    """Download a file attached to notebook `id`.
+
+    Served with `send_file`, so the WSGI server can use zero-copy `sendfile`, and `Range` requests
+    are answered with partial content. The digest doubles as a strong ETag.
+    With an `X-ELN-User` header, only files of the user's own or public notebooks are served (401 otherwise)"""
+
+    nb = _load_notebook(id).notebook
+    _check_access(nb, _acting_user())
+    eln_file = _find_file(nb, uuid)
+    try:
+        path = FILE_STORE.path(eln_file.uuid)
+    except ValueError:
+        flask.abort(404, "The requested resource was not found")
+    if not path.is_file(): flask.abort(404, "The requested resource was not found")
+
+    return flask.send_file(path, download_name=eln_file.name, as_attachment=True, conditional=True, etag=eln_file.uuid)
+
+@app.route("/api/<int:id>/files/<uuid>", methods=["DELETE"])
+def delete_file_eln(id, uuid):
+    """Detach a file from notebook `id` (401 if the `X-ELN-User` may not edit it). The blob is deleted once no
+    notebook refers to it anymore, others may share it"""
+
+    with DB.transaction() as db:
+        fetchres = db.execute("SELECT json FROM electronic_lab_notes WHERE id = ?", (id,)).fetchone()
+        if not fetchres: flask.abort(404, "The requested resource was not found")
+        with tracing.span("validate", model="ELNNotebook"):
+            nb = ELNNotebook.model_validate_json(fetchres[0])
+        _check_access(nb, _acting_user())
+        nb.files.remove(_find_file(nb, uuid))
+        entry = _update_notebook(db, id, nb)
+    _cache_store(id, entry)
+    _collect_orphaned_files()
+
+    response = flask.make_response()
+    response.status_code = 200
+    return response
+
+class ELNSplice(pydantic.BaseModel):
+    """Replace `delete` characters at `start` of the content with `insert`. Positions count UTF-16 code units, like JavaScript strings"""
+    start: int = pydantic.Field(ge=0)
+    delete: int = pydantic.Field(default=0, ge=0)
+    insert: str = ""
+
+class ELNDelta(pydantic.BaseModel):
+    """Incremental change of a notebook, as sent by the editor's autosave"""
+    splices: list[ELNSplice] = []
+    """Changes of the content, applied in order"""
+    length: Optional[int] = None
+    """Length of the content after the splices (UTF-16 code units), to detect editors that diverged from the stored content"""
+    title: Optional[str] = None
+    """New title, if changed"""
+    public: Optional[bool] = None
+    """New visibility, if changed"""
+
+def _apply_splices(content: str, splices: list[ELNSplice]) -> tuple[str, int]:
+    """Apply `splices` to `content`, returns the result and its length in UTF-16 code units.
+    Raises a ValueError if a splice is out of range or splits a character"""
+    units = bytearray(content.encode("utf-16-le"))
+    for splice in splices:
+        start, end = 2 * splice.start, 2 * (splice.start + splice.delete)
+        if end > len(units): raise ValueError("Splice out of range")
+        units[start:end] = splice.insert.encode("utf-16-le")
+    return units.decode("utf-16-le"), len(units) // 2
+
+@app.route("/api/<int:id>/delta", methods=["POST"])
+def post_delta_eln(id):
+    """Apply an incremental change (see `ELNDelta`) to notebook `id`, so editors do not resend the whole content.
+
+    Honours `X-ELN-User` like `PATCH`. Splices only make sense on the version they were made for, so an `If-Match`
+    header naming it is required (428 without, 412 if it is outdated). Fails with a 409 if the splices do not fit the
+    stored content.
+
+    Returns:
+        `{"id": id}`, and the new version as `ETag`"""
+
+    try:
+        with tracing.span("validate", model="ELNDelta"):
+            delta = ELNDelta.model_validate(flask.request.json)
+    except pydantic.ValidationError:
+        flask.abort(415, "JSON did not pass validation")
+
+    user = _acting_user()
+    if_versions = _if_match_versions()
+    if if_versions is None: flask.abort(428, "Deltas require an If-Match header")
+    with DB.transaction() as db:
+        fetchres = db.execute(f"SELECT json FROM electronic_lab_notes WHERE id = :id AND {_WRITE_CONDITIONS_SQL}",
+                              {"id": id, "user": user, "if_versions": json.dumps(if_versions)}).fetchone()
+        if not fetchres: _abort_unmatched(db, id, user)
+        with tracing.span("validate", model="ELNNotebook"):
+            nb = ELNNotebook.model_validate_json(fetchres[0])
+
+        try:
+            nb.content, length = _apply_splices(nb.content, delta.splices)
+        except ValueError:
+            flask.abort(409, "The delta does not apply to the stored content")
+        if delta.length is not None and length != delta.length:
+            flask.abort(409, "The delta does not apply to the stored content")
+        if delta.title is not None: nb.title = delta.title
+        if delta.public is not None: nb.public = delta.public
+        entry = _update_notebook(db, id, nb)
+    _cache_store(id, entry)
+
+    response = flask.jsonify({"id": id})
+    response.set_etag(str(entry.version))
+    return response
+
+MAX_BATCH_OPERATIONS = 5000
+"Upper bound of operations per batch request, as the whole batch holds the database write lock"
+
+class BatchCreate(pydantic.BaseModel):
+    """Batch operation creating a new notebook"""
+    op: Literal["create"]
+    notebook: ELNNotebook
+    """The complete notebook"""
+
+class BatchPatch(pydantic.BaseModel):
+    """Batch operation updating an existing notebook, equivalent to `PATCH /api/<id>`"""
+    op: Literal["patch"]
+    id: int
+    """ID of the notebook to update"""
+    changes: ELNNotebookPatch
+    """The fields to change"""
+    if_version: Optional[int] = None
+    """Only apply if the notebook is at this version (like `If-Match`), otherwise the result is a 412"""
+
+class BatchDelete(pydantic.BaseModel):
+    """Batch operation deleting a notebook"""
+    op: Literal["delete"]
+    id: int
+    """ID of the notebook to delete"""
+
+class BatchModel(pydantic.BaseModel):
+    "The model for JSON payloads submitted to the batch API"
+    operations: list[Annotated[BatchCreate | BatchPatch | BatchDelete, pydantic.Field(discriminator="op")]] = pydantic.Field(max_length=MAX_BATCH_OPERATIONS)
+    """Operations, applied in order"""
+
+@app.route("/api/batch", methods=["POST"])
+def post_batch_eln():
+    """Apply many create/patch/delete operations in one request and one transaction.
+
+    The whole payload is validated upfront; if any operation is malformed, nothing is applied. Operations that fail
+    on their own (unknown ID, version mismatch, no permission of the `X-ELN-User`) are reported in their result and do
+    not affect the others.
+
+    Payload:
+        A JSON compliant with the `BatchModel`
+    Returns:
+        A JSON `{"results": [...]}` with one `{"op", "status", "id"}` per operation, in order
+        (status 201 created, 200 updated/deleted, 404 unknown ID, 401 no permission, 412 version mismatch)"""
+
+    try:
+        with tracing.span("validate", model="BatchModel"):
+            batch = BatchModel.model_validate(flask.request.json)
+    except pydantic.ValidationError as e:
+        return {"errors": e.errors(include_url=False, include_context=False, include_input=False)}, 415
+
+    user = _acting_user()
+    results = []
+    cache_updates = []
+    with DB.transaction() as db:
+        for operation in batch.operations:
+            if operation.op == "create":
+                id, entry = _insert_notebook(db, operation.notebook)
+                cache_updates.append((id, entry))
+                results.append({"op": "create", "status": 201, "id": id})
+
+            elif operation.op == "patch":
+                entry = _patch_notebook(db, operation.id, operation.changes, None if operation.if_version is None else [operation.if_version], user)
+                if entry is None:
+                    results.append({"op": "patch", "status": _unmatched_status(db, operation.id, user), "id": operation.id})
+                    continue
+                cache_updates.append((operation.id, entry))
+                results.append({"op": "patch", "status": 200, "id": operation.id})
+
+            elif operation.op == "delete":
+                tombstone = _delete_notebook(db, operation.id, user=user)
+                if tombstone: cache_updates.append((operation.id, tombstone))
+                results.append({"op": "delete", "status": 200 if tombstone else _unmatched_status(db, operation.id, user), "id": operation.id})
+
+    for id, entry in cache_updates:
+        _cache_store(id, entry)
+    _collect_orphaned_files()
+
+    return {"results": results}
+
+class ELNNotebookSummary(pydantic.BaseModel):
+    """Projection of an `ELNNotebook` for indexes and search results - everything but the (potentially large) content and files"""
+    id: int
+    """The notebook's ID"""
+    creator: str
+    """The owner's user ID"""
+    public: bool = False
+    """Whether or not the notebook is public"""
+    title: str
+    """Short title/description of the notebook"""
+    tags: list[str] = []
+    """List of tags applying to the entry"""
+
+DEFAULT_PAGE_SIZE = 50
+"Page size of query results if the query does not specify a `limit`"
+
+MAX_PAGE_SIZE = 500
+"Upper bound for `limit` on paginated (non-streaming) query results"
+
 class QueryModel(pydantic.BaseModel):
     "The model for JSON queries submitted to the search function"
     user: Optional[str] = None
     """Limit the query to entries visible to this user (own or public). If None, returns all entries"""
     query: Optional[str] = None
-    """The query. If None, return all entries. If present, match against tags and content and only return matching notebooks"""
+    """The query. If None, return all entries. If present, match against tags and content and only return matching notebooks
+    (none if the text has no words, e.g. only punctuation)"""
+    projection: Literal["full", "summary"] = "full"
+    """`full` returns `{"id", "notebook"}` items with the complete `ELNNotebook`, `summary` returns `ELNNotebookSummary` items"""
+    limit: Optional[int] = pydantic.Field(default=None, ge=1)
+    """Maximum number of results. Defaults to `DEFAULT_PAGE_SIZE` for paginated responses and to no limit for streamed ones"""
+    cursor: Optional[str] = None
+    """Opaque `next_cursor` of the previous page; results continue after it"""
+    tags: list[str] = []
+    """Only return notebooks carrying all of these tags"""
+
+_SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+def _fts_match_expression(query: str) -> Optional[str]:
+    """Turn free text into an FTS5 query: every word has to match, as a prefix. Returns None if there are no words"""
+    tokens = _SEARCH_TOKEN_RE.findall(query)
+    if not tokens: return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+# Result items are assembled as JSON text by SQLite, so neither the notebook JSON nor its HTML is parsed on the way out
+_FULL_ITEM_SQL = """'{"id":' || n.id || ',"notebook":' || n.json || '}'"""
+_SUMMARY_ITEM_SQL = """json_object('id', n.id, 'creator', n.creator, 'public', json(CASE WHEN n.public THEN 'true' ELSE 'false' END),
+                                   'title', n.title, 'tags', json_extract(n.json, '$.tags'))"""
+
+_MAX_ID = 2**63 - 1
+
+def _query_notebooks(db: sqlite3.Connection, query: QueryModel, limit: Optional[int]) -> sqlite3.Cursor:
+    """Run the query as keyset pagination and return a cursor over `(id, rank, item_json)` rows.
+
+    Without a text query, results are ordered by descending ID, the cursor is the last ID. For a user the visible notebooks
+    are merged from the `public` and `creator` indexes (or read from the tag table if filtering by tags),
+    so only `limit` rows are ever visited.
+    With a text query, results are ordered by bm25 rank (title and tags weighted above the body), the cursor is `rank:id`.
+    A text query without any words matches nothing.
+    
+    Raises a 400 on a malformed cursor"""
+
+    item = _SUMMARY_ITEM_SQL if query.projection == "summary" else _FULL_ITEM_SQL
+    sql_limit = limit if limit is not None else -1
+    match = _fts_match_expression(query.query) if query.query else None
+    if query.query and match is None:
+        # searching for nothing is not the same as not searching
+        return db.execute("SELECT NULL, NULL, NULL WHERE 0")
+
+    after_rank, after_id = None, (0 if match else _MAX_ID)
+    if query.cursor:
+        try:
+            if match:
+                rank, _, id = query.cursor.partition(":")
+                after_rank, after_id = float(rank), int(id)
+            else:
+                after_id = int(query.cursor)
+        except ValueError:
+            flask.abort(400, "Malformed cursor")
+
+    params = {"match": match, "user": query.user, "rank": after_rank, "id": after_id, "limit": sql_limit}
+    params.update((f"tag{i}", tag) for i, tag in enumerate(query.tags))
+
+    def tag_filter(column: str, tags: range) -> str:
+        return "".join(f" AND {column} IN (SELECT notebook_id FROM electronic_lab_notes_tags WHERE tag = :tag{i})" for i in tags)
+
+    if not match and query.tags:
+        # driven by the tag table: its primary key yields the notebooks of the first tag in ID order
+        visibility = "AND (public = 1 OR creator = :user)" if query.user else ""
+        return db.execute(f"""SELECT n.id, NULL, {item} FROM electronic_lab_notes AS n WHERE n.id IN (
+                                  SELECT notebook_id FROM electronic_lab_notes_tags WHERE tag = :tag0 AND notebook_id < :id {visibility}
+                                  {tag_filter("notebook_id", range(1, len(query.tags)))}
+                                  ORDER BY notebook_id DESC LIMIT :limit)
+                              ORDER BY n.id DESC""", params)
+    elif not match and query.user:
+        return db.execute(f"""SELECT n.id, NULL, {item} FROM electronic_lab_notes AS n WHERE n.id IN (
+                                  SELECT id FROM electronic_lab_notes WHERE public = 1 AND id < :id
+                                  UNION SELECT id FROM electronic_lab_notes WHERE creator = :user AND id < :id
+                                  ORDER BY id DESC LIMIT :limit)
+                              ORDER BY n.id DESC""", params)
+    elif not match:
+        return db.execute(f"""SELECT n.id, NULL, {item} FROM electronic_lab_notes AS n WHERE n.id < :id
+                              ORDER BY n.id DESC LIMIT :limit""", params)
+
+    visibility = "AND (n.public = 1 OR n.creator = :user)" if query.user else ""
+    keyset = "AND (f.rank > :rank OR (f.rank = :rank AND n.id > :id))" if after_rank is not None else ""
+    return db.execute(f"""SELECT n.id, f.rank, {item} FROM electronic_lab_notes_fts AS f JOIN electronic_lab_notes AS n ON n.id = f.rowid
+                          WHERE electronic_lab_notes_fts MATCH :match AND f.rank MATCH 'bm25(10.0, 1.0, 5.0)' {visibility} {keyset}
+                          {tag_filter("n.id", range(len(query.tags)))}
+                          ORDER BY f.rank, n.id LIMIT :limit""", params)
+
+def _next_cursor(row: tuple) -> str:
+    """Cursor pointing behind the given result row"""
+    id, rank, _ = row
+    return str(id) if rank is None else f"{rank!r}:{id}"
 
 @app.route("/api/query", methods=["POST"])
 def post_query_eln():
-    """Query the ELN server and return matching notebooks
+    """Query the ELN server and return matching notebooks, one page at a time
+
+    Text queries go through the full text index over title, content (without markup) and tags,
+    results are ordered by relevance. Other queries return the newest notebooks first.
+
+    If the request `Accept`s `application/x-ndjson` (and not `application/json`), the results are streamed
+    as one JSON item per line instead. They are read in pages of `MAX_PAGE_SIZE`, each one before it is sent,
+    so a slow client does not hold a database connection.
     
     Payload:
         A JSON compliant with the `QueryModel`
     Returns:
-        A JSON list of `ELNNotebook` instances"""
+        A JSON `{"results": [...], "next_cursor": <str or null>}`, the items depending on the `projection`"""
     
-    query = QueryModel.model_validate(flask.request.json)
+    try:
+        with tracing.span("validate", model="QueryModel"):
+            query = QueryModel.model_validate(flask.request.json)
+    except pydantic.ValidationError:
+        flask.abort(415, "JSON did not pass validation")
+
+    if flask.request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        def fetch(page: QueryModel, remaining: Optional[int]) -> tuple[list, bool]:
+            """The next page of rows, and whether it is the last one"""
+            size = MAX_PAGE_SIZE if remaining is None else min(remaining, MAX_PAGE_SIZE)
+            with DB.connection() as db:
+                rows = _query_notebooks(db, page, size).fetchall()
+            return rows, len(rows) < size or remaining == size
+
+        def stream(rows: list, last: bool):
+            page, remaining = query.model_copy(), query.limit
+            while True:
+                yield "".join(item + "\n" for _, _, item in rows)
+                if last: return
+                # continue behind the page just sent, with the connection released in between
+                page.cursor = _next_cursor(rows[-1])
+                if remaining is not None: remaining -= len(rows)
+                rows, last = fetch(page, remaining)
+
+        # the first page is read upfront, so a malformed cursor or an exhausted pool fail the request, not the stream
+        return flask.Response(flask.stream_with_context(stream(*fetch(query, query.limit))), mimetype="application/x-ndjson")
+
+    limit = min(query.limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    with DB.connection() as db:
+        # fetch one more row than requested to know whether there is a next page
+        rows = _query_notebooks(db, query, limit + 1).fetchall()
+
+    next_cursor = _next_cursor(rows[limit - 1]) if len(rows) > limit else None
+    body = '{"results":[' + ",".join(row[2] for row in rows[:limit]) + '],"next_cursor":' + json.dumps(next_cursor) + "}"
+    return flask.Response(body, mimetype="application/json")
+
+class FacetModel(pydantic.BaseModel):
+    "The model for JSON requests of tag facet counts"
+    user: Optional[str] = None
+    """Only count notebooks visible to this user (own or public). If None, counts all notebooks"""
+    limit: int = pydantic.Field(default=50, ge=1)
+    """Maximum number of tags, the most frequent first"""
 
-    db = sqlite3.connect(DB_PATH, autocommit=True)
-    cursor = db.cursor()
+@app.route("/api/tags", methods=["POST"])
+def post_tags_eln():
+    """Count the notebooks per tag, answered from the tag table's indexes
 
-    if query.user and not query.query:
-        cursor.execute("""SELECT id,json FROM electronic_lab_notes WHERE (json_extract(json, "$.public") = true OR json_extract(json, "$.creator") = ?)""", (query.user,))
-    elif query.user and query.query:
-        cursor.execute("""SELECT id,json FROM electronic_lab_notes WHERE (json_extract(json, "$.public") = true OR json_extract(json, "$.creator") = ?) AND json LIKE ?""", (query.user,f"%{query.query}%"))
-    elif query.query:
-        cursor.execute("""SELECT id,json FROM electronic_lab_notes WHERE json LIKE %?%""", (query.user,query.query))
-    
-    queryres = cursor.fetchall()
-    cursor.close()
-    db.close()
+    Payload:
+        A JSON compliant with the `FacetModel`
+    Returns:
+        A JSON list of `{"tag", "count"}`, most frequent first"""
 
-    return queryres
+    try:
+        with tracing.span("validate", model="FacetModel"):
+            facets = FacetModel.model_validate(flask.request.json)
+    except pydantic.ValidationError:
+        flask.abort(415, "JSON did not pass validation")
+
+    visibility = "WHERE public = 1 OR creator = :user" if facets.user else ""
+    with DB.connection() as db:
+        rows = db.execute(f"""SELECT tag, count(*) AS count FROM electronic_lab_notes_tags {visibility}
+                              GROUP BY tag ORDER BY count DESC, tag LIMIT :limit""",
+                          {"user": facets.user, "limit": facets.limit}).fetchall()
+
+    return [{"tag": tag, "count": count} for tag, count in rows]
+
+@app.route("/metrics")
+def get_metrics():
+    """Timing histograms of requests, database access and validation, in the Prometheus text format"""
+    return tracing.metrics_response()
 
 if __name__ == "__main__":
     # Establish database connection and, if necessary, scheme
-    DB_PATH = pathlib.Path(__file__).parent / "store" / "eln_db.sqlite"
     print("Connecting to db", DB_PATH)
-    db = sqlite3.connect(DB_PATH, autocommit=True)
-
-    cursor = db.cursor()
-    cursor.execute("""CREATE TABLE IF NOT EXISTS electronic_lab_notes(id INTEGER PRIMARY KEY, json TEXT)""")
-    cursor.close()
-    db.close()
+    init_db()
 
 
     app.run(port=5001, host="0.0.0.0")
\ No newline at end of file
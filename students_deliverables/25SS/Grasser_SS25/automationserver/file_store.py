@@ -0,0 +1,103 @@
+"""Content addressed storage for files attached to notebooks
+
+Files are stored once per content under their SHA-256 hex digest, sharded by the first two hex digits
+(`<root>/ab/ab12...`). Identical uploads - the same instrument export attached to several notebooks - share one blob.
+Blobs are written and read in chunks, so file size is not bounded by memory. Blobs no longer attached to any notebook
+are deleted by the ELN server (see `eln_server._collect_orphaned_files`)."""
+
+import hashlib
+import os
+import pathlib
+import re
+import tempfile
+from typing import BinaryIO, NamedTuple
+
+_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class ContentStore:
+    """A directory of immutable blobs addressed by their SHA-256 digest"""
+
+    def __init__(self, root: str | pathlib.Path, chunk_size: int = 1024 * 1024):
+        self.root = pathlib.Path(root)
+        """Directory holding the blobs"""
+        self.chunk_size = chunk_size
+        """Bytes read from the upload stream at a time"""
+
+    def path(self, digest: str) -> pathlib.Path:
+        """Location of the blob with `digest`. Raises a ValueError for anything that is not a SHA-256 hex digest"""
+        if not _DIGEST_RE.fullmatch(digest):
+            raise ValueError(f"Not a SHA-256 hex digest: {digest!r}")
+        return self.root / digest[:2] / digest
+
+    def exists(self, digest: str) -> bool:
+        """Whether a blob with `digest` is stored"""
+        return self.path(digest).is_file()
+
+    def stage(self, stream: BinaryIO) -> "StagedBlob":
+        """Write everything readable from `stream` to a temporary file next to the blobs, hashing it on the way.
+        Store it with `commit()` (or drop it with `discard()`); until then it is not visible to readers"""
+
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+
+        fd, tmp_name = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while (chunk := stream.read(self.chunk_size)):
+                    sha.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+        except BaseException:
+            if os.path.exists(tmp_name): os.unlink(tmp_name)
+            raise
+        return StagedBlob(tmp_name, sha.hexdigest(), size)
+
+    def commit(self, staged: "StagedBlob"):
+        """Move a staged blob into place atomically, so readers never see partial blobs. If the content is already
+        stored, the temporary file is discarded"""
+        target = self.path(staged.digest)
+        if target.exists():
+            self.discard(staged)
+        else:
+            target.parent.mkdir(exist_ok=True)
+            os.replace(staged.tmp_name, target)
+
+    def discard(self, staged: "StagedBlob"):
+        """Remove the temporary file of a staged blob, if it was not committed"""
+        if os.path.exists(staged.tmp_name): os.unlink(staged.tmp_name)
+
+    def put_stream(self, stream: BinaryIO) -> tuple[str, int]:
+        """Store everything readable from `stream`, see `stage()` and `commit()`
+
+        Returns:
+            the hex digest and size in bytes of the stored content"""
+
+        staged = self.stage(stream)
+        try:
+            self.commit(staged)
+        finally:
+            self.discard(staged)
+        return staged.digest, staged.size
+
+    def delete(self, digest: str) -> bool:
+        """Remove the blob with `digest`, returns whether there was one"""
+        try:
+            self.path(digest).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class StagedBlob(NamedTuple):
+    """Content written by `ContentStore.stage()`, not stored yet"""
+    tmp_name: str
+    """Path of the temporary file"""
+    digest: str
+    """SHA-256 hex digest of the content"""
+    size: int
+    """Size in bytes"""
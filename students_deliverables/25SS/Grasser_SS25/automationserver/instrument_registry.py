@@ -0,0 +1,98 @@
+"""Registry of simulated instruments, one per bench (or session)"""
+
+import threading
+import time
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class RegistryFullError(RuntimeError):
+    """Raised when a new instrument is requested, but every slot holds one that is in use"""
+
+
+class _Entry(Generic[T]):
+    __slots__ = ("instance", "last_used")
+
+    def __init__(self, instance: T):
+        self.instance = instance
+        self.last_used = time.monotonic()
+
+
+class InstrumentRegistry(Generic[T]):
+    """Instruments by key, created on first use by `factory(key)`
+
+    Lookups of existing instruments take no lock, only creating and evicting instruments does. Memory is bounded:
+    instruments unused for `idle_timeout_s` are evicted, and once `max_instruments` exist, the least recently used
+    one makes room for a new one. Instruments for which `in_use` returns True (e.g. with viewers) are never evicted."""
+
+    def __init__(self,
+                 factory: Callable[[Hashable], T],
+                 max_instruments: int = 256,
+                 idle_timeout_s: float = 3600,
+                 in_use: Callable[[T], bool] = lambda instance: False):
+        self.factory = factory
+        """Creates the instrument for a key"""
+        self.max_instruments = max_instruments
+        """Upper bound of instruments held at once"""
+        self.idle_timeout_s = idle_timeout_s
+        """Instruments unused for this long are evicted"""
+        self.in_use = in_use
+        """Whether an instrument must not be evicted, regardless of its last use"""
+
+        self._entries: dict[Hashable, _Entry[T]] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> T:
+        """The instrument for `key`, created if there is none yet. Raises a `RegistryFullError` if none can be evicted to make room"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._create(key)
+        entry.last_used = time.monotonic()
+        return entry.instance
+
+    def peek(self, key: Hashable) -> Optional[T]:
+        """The instrument for `key` if there is one, without creating it or counting as use"""
+        entry = self._entries.get(key)
+        return entry.instance if entry else None
+
+    def evict_idle(self) -> int:
+        """Evict all instruments unused for `idle_timeout_s` (and not in use), returns how many"""
+        with self._lock:
+            return self._evict_idle()
+
+    def _evict_idle(self) -> int:
+        now = time.monotonic()
+        self._last_sweep = now
+        idle = [key for key, entry in self._entries.items()
+                if now - entry.last_used > self.idle_timeout_s and not self.in_use(entry.instance)]
+        for key in idle:
+            del self._entries[key]
+        return len(idle)
+
+    def _create(self, key: Hashable) -> T:
+        with self._lock:
+            if (entry := self._entries.get(key)) is not None:
+                # created by another thread in the meantime
+                entry.last_used = time.monotonic()
+                return entry.instance
+
+            if time.monotonic() - self._last_sweep > self.idle_timeout_s / 2:
+                self._evict_idle()
+            if len(self._entries) >= self.max_instruments:
+                self._evict_idle()
+            if len(self._entries) >= self.max_instruments:
+                candidates = [(entry.last_used, candidate) for candidate, entry in self._entries.items() if not self.in_use(entry.instance)]
+                if not candidates: raise RegistryFullError(f"All {self.max_instruments} instruments are in use")
+                del self._entries[min(candidates, key=lambda candidate: candidate[0])[1]]
+
+            entry = _Entry(self.factory(key))
+            self._entries[key] = entry
+            return entry.instance
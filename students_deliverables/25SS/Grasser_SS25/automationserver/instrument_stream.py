@@ -0,0 +1,98 @@
+"""Server-side sampling of instruments, broadcast to Socket.IO rooms
+
+Instead of every browser tab polling the instrument, one background task samples it and pushes the readings to all
+subscribers of a room at once: N viewers cost one sample stream, not N request/response loops."""
+
+import threading
+import time
+from typing import Callable, Optional
+
+import flask_socketio
+
+
+class SampleBroadcaster:
+    """Samples an instrument in a background task while anyone is subscribed, and broadcasts to a Socket.IO room
+
+    Samples are taken every `sample_interval_s`, but broadcast at most every `broadcast_interval_s`; the samples taken
+    in between are coalesced into one message by `coalesce` (by default, the latest sample wins). `publish()` marks a
+    change of the instrument: the samples taken before it are dropped, so they are never coalesced with later ones."""
+
+    def __init__(self,
+                 socketio: flask_socketio.SocketIO,
+                 event: str,
+                 room: str,
+                 sample: Callable[[], dict],
+                 sample_interval_s: float = 0.25,
+                 broadcast_interval_s: float = 1.0,
+                 coalesce: Optional[Callable[[list[dict]], dict]] = None):
+        self.socketio = socketio
+        """The Socket.IO server to broadcast with"""
+        self.event = event
+        """Name of the broadcast event"""
+        self.room = room
+        """Room of the subscribers"""
+        self.sample = sample
+        """Takes one sample of the instrument"""
+        self.sample_interval_s = sample_interval_s
+        """Time between two samples"""
+        self.broadcast_interval_s = broadcast_interval_s
+        """Minimum time between two broadcasts"""
+        self.coalesce = coalesce or (lambda samples: samples[-1])
+        """Merges the samples taken since the last broadcast into one message"""
+
+        self._subscribers: set[str] = set()
+        self._lock = threading.Lock()
+        self._running = False
+        self._generation = 0
+
+    @property
+    def subscribers(self) -> int:
+        """Number of subscribed clients"""
+        return len(self._subscribers)
+
+    def subscribe(self, sid: str):
+        """Add the Socket.IO client `sid` to the room and start sampling, if not running yet. Call from an event handler"""
+        flask_socketio.join_room(self.room, sid=sid)
+        with self._lock:
+            self._subscribers.add(sid)
+            if self._running: return
+            self._running = True
+        self.socketio.start_background_task(self._run)
+
+    def unsubscribe(self, sid: str):
+        """Remove the client `sid` from the room (e.g. on disconnect). Sampling stops once nobody is subscribed. Call from an event handler"""
+        flask_socketio.leave_room(self.room, sid=sid)
+        with self._lock:
+            self._subscribers.discard(sid)
+
+    def publish(self, message: Optional[dict] = None):
+        """Broadcast `message` (or a fresh sample) right away, e.g. after the instrument state changed"""
+        with self._lock:
+            self._generation += 1
+        self.socketio.emit(self.event, message if message is not None else self.sample(), to=self.room)
+
+    def _run(self):
+        """The background task: sample, and broadcast the coalesced samples once per broadcast interval"""
+        samples = []
+        generation = None
+        next_broadcast = time.monotonic() + self.broadcast_interval_s
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._running = False
+                    return
+                if generation != self._generation:
+                    # the instrument changed (and was published) since these samples were taken
+                    samples, generation = [], self._generation
+
+            sample = self.sample()
+            with self._lock:
+                # after a change during sampling, it is unclear which state the sample shows
+                if generation == self._generation: samples.append(sample)
+            if samples and time.monotonic() >= next_broadcast:
+                self.socketio.emit(self.event, self.coalesce(samples), to=self.room)
+                samples = []
+                next_broadcast += self.broadcast_interval_s
+                # do not try to catch up on broadcasts missed while the task was stalled
+                next_broadcast = max(next_broadcast, time.monotonic())
+            self.socketio.sleep(self.sample_interval_s)
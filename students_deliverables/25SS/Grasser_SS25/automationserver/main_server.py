@@ -1,46 +1,70 @@
 """Main application - a flask server to provide the frontend.
 
-Also provides the simulated pH-Meter with an included SocketIO wrapper for communication"""
+Also provides the simulated pH-Meter with an included SocketIO wrapper for communication
+
+Runs as development server with `python -m automationserver.main_server`. In production, run one threaded gunicorn
+process per instance (Socket.IO needs every client to stay on one process), e.g.
+
+    python -m automationserver.user_store migrate
+    gunicorn -w 1 --threads 100 -b 0.0.0.0:5000 automationserver.main_server:app
+
+and scale out with several instances behind a sticky load balancer, sharing `SECRET_KEY` and
+`SOCKETIO_MESSAGE_QUEUE` - see `docker-compose.scale.yaml` and `deploy/nginx.conf`."""
 
 import flask
 import flask_login
 import flask_socketio
+import threading
 import uuid
 import automationserver.virtual_phmeter
 import pydantic
 from typing import Literal, Optional
-import requests
 import os
-import hashlib
-from automationserver.eln_server import ELNNotebook
+from automationserver.eln_server import ELNDelta, ELNNotebook, ELNNotebookSummary
+from automationserver.eln_client import ELNClient, ELNError
+from automationserver.eln_autosave import DeltaCoalescer
+from automationserver.instrument_stream import SampleBroadcaster
+from automationserver.instrument_registry import InstrumentRegistry, RegistryFullError
+from automationserver.user_store import UserStore
+from automationserver.cache import FragmentCache, make_cache
+from automationserver import tracing
 import pathlib
-import sqlite3
 
 OWN_PATH = pathlib.Path(__file__)
 
 app = flask.Flask(__file__, static_folder=OWN_PATH.parent /"static", template_folder= OWN_PATH.parent / "templates")
-app.config["SECRET_KEY"] = uuid.uuid4().__str__()
+tracing.instrument_app(app)
+app.config["SECRET_KEY"] = secret_key if (secret_key := os.environ.get("SECRET_KEY")) else uuid.uuid4().__str__()
+"Signs the session cookies; has to be the same for all instances, otherwise logins only work on the instance that issued them"
 
 
 # configurations either from env vars for docker or test defaults
 
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+"Message queue (e.g. `redis://redis:6379/1`) relaying Socket.IO broadcasts to the clients of all instances; None for a single instance"
+
 ENDPOINT_ELN = ep_eln if (ep_eln := os.environ.get("ENDPOINT_ELN")) else "http://localhost:5001/api/"
 "Endpoint for REST requests to the electronic notebook; localhost for local testing, overridden by the image"
 
+FRAGMENT_CACHE_URL = os.environ.get("FRAGMENT_CACHE_URL")
+"Redis compatible server (`redis://host:6379/0`) for rendered pages, shared by all workers; if unset, an in-process LRU"
+
+FRAGMENT_CACHE_TTL_S = float(os.environ.get("FRAGMENT_CACHE_TTL_S", 60))
+"Maximum age of a cached page, bounds staleness after ELN writes that did not go through this frontend"
+
+ELN_AUTOSAVE_FLUSH_S = float(os.environ.get("ELN_AUTOSAVE_FLUSH_S", 1.0))
+"Time autosave deltas of an editor are collected before they are written to the ELN as one"
+
 
 # authentication / user management
-# no frontend user management - users are stored in `users_db.sqlite`, as username and sha512 hexdigest()
+# no frontend user management - users are stored in `user_db.sqlite`, see `user_store` to add users
 
 login_manager = flask_login.LoginManager()
 login_manager.login_view = ".get_login"
 login_manager.init_app(app)
 
-def calc_sha512_hexdigest(password: str) -> str:
-    """Hashes the given `password` and returns the SHA512 hexdigest to match against the database"""
-
-    sha = hashlib.sha512()
-    sha.update(password.encode())
-    return sha.hexdigest()
+USERS = UserStore()
+"Pooled, cached access to the user accounts. The scheme is migrated on startup, not on import (see `__main__`)"
 
 
 class User(flask_login.UserMixin):
@@ -77,83 +101,248 @@ def get_login():
 def post_login():
     """Authenticate the user vs. the database"""
 
-    print(flask.request.form["user"], flask.request.form["password"])
-
-    db = sqlite3.connect(OWN_PATH.parent / "store/user_db.sqlite", autocommit=True)
-    cursor = db.cursor()
-    queryres = cursor.execute("SELECT * FROM users WHERE username = ?", (flask.request.form.get("user"),)).fetchone()
-    if not queryres: flask.abort(401)
-    if not calc_sha512_hexdigest(flask.request.form.get("password")) == queryres[2]: flask.abort(401)
-    flask_login.login_user(User(queryres[1]))
+    user = USERS.authenticate(flask.request.form.get("user", ""), flask.request.form.get("password", ""))
+    if not user: flask.abort(401)
+    flask_login.login_user(User(user.username))
     return flask.redirect("/", 301)
 
 
 
 # pHmeter control interface and associated websocket handlers
-socketio = flask_socketio.SocketIO(app, cors_allowed_origins="*")
-
-pHMeter = automationserver.virtual_phmeter.pHMeter()
+socketio = flask_socketio.SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+PHMETER_SAMPLE_INTERVAL_S = float(os.environ.get("PHMETER_SAMPLE_INTERVAL_S", 0.25))
+"Time between two samples of the pH meter readout"
+
+PHMETER_BROADCAST_INTERVAL_S = float(os.environ.get("PHMETER_BROADCAST_INTERVAL_S", 1.0))
+"Minimum time between two broadcasts to the viewers, the samples in between are averaged"
+
+PHMETER_MAX_BENCHES = int(os.environ.get("PHMETER_MAX_BENCHES", 256))
+"Upper bound of the users' own simulated pH meters held at once"
+
+PHMETER_MAX_SHARED_BENCHES = int(os.environ.get("PHMETER_MAX_SHARED_BENCHES", 32))
+"Upper bound of shared (named) benches held at once, apart from the own ones"
+
+PHMETER_IDLE_TIMEOUT_S = float(os.environ.get("PHMETER_IDLE_TIMEOUT_S", 3600))
+"Benches unused (and unwatched) for this long are discarded"
+
+PHMETER_SENSOR_RATE_HZ = float(os.environ.get("PHMETER_SENSOR_RATE_HZ", 100))
+"Rate the simulated sensor of each bench is sampled at; a readout averages the samples of one sample interval"
+
+PHMETER_HISTORY_SAMPLES = int(os.environ.get("PHMETER_HISTORY_SAMPLES", 8192))
+"Sensor samples kept per bench (about 3 * 16 bytes each)"
+
+PHMETER_HISTORY_POINTS = 200
+"Points of the downsampled history sent to the clients"
+
+def _average_readouts(samples: list[dict]) -> dict:
+    """Coalesce samples into one, averaging the noisy readout over the samples at the latest volume"""
+    latest = samples[-1]
+    readouts = [sample["pH"] for sample in samples if sample["volume_added"] == latest["volume_added"]]
+    return latest | {"pH": sum(readouts) / len(readouts)}
+
+class PHMeterBench:
+    """One bench: a simulated pH meter and the stream of its readouts to the bench's Socket.IO room"""
+
+    def __init__(self, bench_id: str):
+        self.bench_id = bench_id
+        """The bench's ID - `bench:<name>` for a shared bench, `user:<id>` or `session:<sid>` for a client's own one"""
+        self.sensor = self._sensor()
+        """The simulated pH meter's sensor, keeping a history of readouts sampled on demand"""
+        self.endpoint = automationserver.virtual_phmeter.EndpointDetector()
+        """Detects the equivalence point from the readouts"""
+        self._endpoint_lock = threading.Lock()
+        self.stream = SampleBroadcaster(socketio, "phmeter", f"phmeter/{bench_id}", self.state,
+                                        sample_interval_s=PHMETER_SAMPLE_INTERVAL_S,
+                                        broadcast_interval_s=PHMETER_BROADCAST_INTERVAL_S,
+                                        coalesce=_average_readouts)
+        """Pushes the readout to all clients watching the bench, sampled once for all of them"""
+
+    @staticmethod
+    def _sensor() -> automationserver.virtual_phmeter.pHSensorStream:
+        return automationserver.virtual_phmeter.pHSensorStream(automationserver.virtual_phmeter.pHMeter(),
+                                                               rate_hz=PHMETER_SENSOR_RATE_HZ, capacity=PHMETER_HISTORY_SAMPLES)
+
+    @property
+    def meter(self) -> automationserver.virtual_phmeter.pHMeter:
+        """The simulated pH meter"""
+        return self.sensor.meter
+
+    def state(self) -> dict:
+        sensor = self.sensor
+        meter = sensor.meter
+        sensor.fill()
+        volume = meter.added_volume_mL
+        recent = sensor.recent(PHMETER_SAMPLE_INTERVAL_S)
+        # right after titrating, the recent samples still show the previous volume
+        recent_pH = recent[sensor.PH, recent[sensor.VOLUME] == volume]
+        pH = float(recent_pH.mean()) if recent_pH.size else meter.readout
+        with self._endpoint_lock:
+            endpoint = self.endpoint.update(volume, pH)
+        return {"pH": pH, "volume_added": volume, "endpoint": endpoint}
+
+    def history(self) -> dict:
+        """The sensor history, downsampled for charts"""
+        sensor = self.sensor
+        sensor.fill()
+        samples = sensor.history.downsampled(PHMETER_HISTORY_POINTS)
+        return {"time_s": samples[sensor.TIME].tolist(), "volume_added": samples[sensor.VOLUME].tolist(),
+                "pH": samples[sensor.PH].tolist()}
+
+    def add(self, volume_mL: float):
+        """Titrate; the samples due until now are taken first, so they still show the previous volume"""
+        sensor = self.sensor
+        sensor.fill()
+        sensor.meter.add(volume_mL)
+
+    def reset(self):
+        """Start over with a new meter. Swapping the instance means concurrent readers never see a half reset meter"""
+        self.sensor = self._sensor()
+        with self._endpoint_lock:
+            self.endpoint.reset()
+
+PHMETER_BENCHES: InstrumentRegistry[PHMeterBench] = InstrumentRegistry(
+    PHMeterBench, max_instruments=PHMETER_MAX_BENCHES, idle_timeout_s=PHMETER_IDLE_TIMEOUT_S,
+    in_use=lambda bench: bench.stream.subscribers > 0)
+"The users' own benches by ID, each client works on its own (or a shared, named) bench"
+
+PHMETER_SHARED_BENCHES: InstrumentRegistry[PHMeterBench] = InstrumentRegistry(
+    PHMeterBench, max_instruments=PHMETER_MAX_SHARED_BENCHES, idle_timeout_s=PHMETER_IDLE_TIMEOUT_S,
+    in_use=lambda bench: bench.stream.subscribers > 0)
+"""The shared benches by ID. Any client can name one, so they have a capacity of their own: opening many of them
+only evicts other shared benches, never someone's own"""
+
+def _bench_registry(bench_id: str) -> InstrumentRegistry[PHMeterBench]:
+    """The registry holding the bench `bench_id`"""
+    return PHMETER_SHARED_BENCHES if bench_id.startswith("bench:") else PHMETER_BENCHES
+
+_phmeter_subscriptions: dict[str, str] = {}
+"Bench ID subscribed to by each Socket.IO client"
 
 class pHMeter_Command_Model(pydantic.BaseModel):
     """JSON validation model for the titration"""
-    action: Literal["poll", "add_volume", "reset"]
+    action: Literal["subscribe", "poll", "history", "add_volume", "reset"]
     volume: Optional[float] = None
+    bench: Optional[str] = pydantic.Field(default=None, max_length=64)
+    """Shared bench to work on. If None, the user's own bench"""
 
 @app.route("/phmeter/")
 @flask_login.login_required
 def get_phmeter_control():
-    return flask.render_template("phmetercontrol.jinja")
+    # the owner of the user's own bench, for the load balancer to route all their connections to one instance
+    return flask.render_template("phmetercontrol.jinja", owner=flask_login.current_user.id)
 
 @socketio.on("phmeter")
 def handle_ph_meter(message: dict):
 
     requestobj = pHMeter_Command_Model.model_validate(message)
-
-    if requestobj.action == "poll":
-        flask_socketio.emit("phmeter", {"pH": pHMeter.readout, "volume_added": pHMeter.added_volume_mL})
+    user = flask_login.current_user
+    # shared benches get a namespace of their own, so a bench name can never address someone's own bench
+    if requestobj.bench: bench_id = f"bench:{requestobj.bench}"
+    else: bench_id = f"user:{user.id}" if user.is_authenticated else f"session:{flask.request.sid}"
+    try:
+        bench = _bench_registry(bench_id).get(bench_id)
+    except RegistryFullError:
+        flask_socketio.emit("phmeter", {"status":"warning: all instruments are in use, try again later"})
+        return
+
+    if requestobj.action == "subscribe":
+        # readouts are pushed from now on, no polling necessary
+        previous = _phmeter_subscriptions.get(flask.request.sid)
+        if previous and previous != bench_id and (previous_bench := _bench_registry(previous).peek(previous)):
+            previous_bench.stream.unsubscribe(flask.request.sid)
+        _phmeter_subscriptions[flask.request.sid] = bench_id
+        bench.stream.subscribe(flask.request.sid)
+        flask_socketio.emit("phmeter", bench.state())
+
+    elif requestobj.action == "poll":
+        flask_socketio.emit("phmeter", bench.state())
+
+    elif requestobj.action == "history":
+        flask_socketio.emit("phmeter_history", bench.history())
 
     elif requestobj.action == "add_volume":
-        pHMeter.add(requestobj.volume)
+        bench.add(requestobj.volume)
         print("adding ", message.get("volume"), "mL")
-        flask_socketio.emit("phmeter", {"pH": pHMeter.readout, "volume_added": pHMeter.added_volume_mL})
+        bench.stream.publish()
     
     elif requestobj.action == "reset":
-        pHMeter.__init__()
-        flask_socketio.emit("phmeter", {"pH": pHMeter.readout, "volume_added": pHMeter.added_volume_mL})
+        bench.reset()
+        bench.stream.publish()
 
     else:
         flask_socketio.emit("phmeter", {"status":"warning: could not interpret action!"})
         print("Unknown action - Fallback, this should not be possible")
 
+@socketio.on("disconnect")
+def handle_disconnect(*args):
+    bench_id = _phmeter_subscriptions.pop(flask.request.sid, None)
+    if bench_id and (bench := _bench_registry(bench_id).peek(bench_id)):
+        bench.stream.unsubscribe(flask.request.sid)
+    ELN_AUTOSAVE.discard(flask.request.sid)
+
 
 # Electronic Lab Notebook routes and handlers
 
-def _retrieve_notebook(id: int) -> ELNNotebook:
-    """Retrieve a specified notebook from the eln server"""
-    notebook_query = requests.get(ENDPOINT_ELN+f"{id}")
-    queried_notebook = ELNNotebook.model_validate(notebook_query.json())
+ELN = ELNClient(ENDPOINT_ELN)
+"Shared, connection pooled client for all calls to the ELN server"
+
+@app.errorhandler(ELNError)
+def handle_eln_error(error: ELNError):
+    """Pass failed ELN server calls on as the corresponding HTTP error"""
+    return error.message, error.status_code
+
+@app.route("/metrics")
+@flask_login.login_required
+def get_metrics():
+    """Timing histograms of requests, calls to the ELN server, rendering and the user database, in the Prometheus text format"""
+    return tracing.metrics_response()
+
+PAGE_CACHE = FragmentCache(make_cache(FRAGMENT_CACHE_URL, maxsize=2048, prefix="eln-pages:"), ttl_s=FRAGMENT_CACHE_TTL_S)
+"""Rendered ELN pages. Notebook pages are kept per user and notebook version, index pages per user and query;
+writes through this frontend move the affected namespaces to a new generation"""
 
-    return queried_notebook
+def _invalidate_pages(id: Optional[int] = None, etag: Optional[str] = None):
+    """Drop cached index pages and, if given, those of notebook `id` (moving it to version `etag`, if known)"""
+    PAGE_CACHE.invalidate("eln_index")
+    if id is not None: PAGE_CACHE.invalidate(f"eln_notebook/{id}", etag)
+
+def _retrieve_notebook(id: int) -> tuple[ELNNotebook, Optional[str]]:
+    """Retrieve a specified notebook from the eln server, together with its ETag (identifying the version)"""
+    return ELN.get_notebook(id)
 
 @app.route("/eln/")
 @flask_login.login_required
 def get_eln_index():
     """Query multiple notebooks and display an overview. Requires user to be authorized to view them.
     
-    Doubles as search function via query GET argument."""
+    Doubles as search function via query GET argument, and can be filtered by (repeated) tag GET arguments."""
 
-    payload = {"user":flask_login.current_user.id}
+    payload = {"user":flask_login.current_user.id, "projection": "summary"}
 
     if (query := flask.request.args.get("query")):
         payload ["query"] = query
         print(payload)
-    notebooks_query = requests.post(ENDPOINT_ELN+ "query", json = payload)
+    if (tags := flask.request.args.getlist("tag")):
+        payload["tags"] = tags
+    if (cursor := flask.request.args.get("cursor")):
+        payload["cursor"] = cursor
+
+    cache_key = (flask_login.current_user.id, query, tuple(tags), cursor)
+    if (page := PAGE_CACHE.get("eln_index", cache_key)) is not None:
+        return page
+
+    generation = PAGE_CACHE.generation("eln_index")  # before fetching, so a concurrent write is not cached over
+    notebooks_query = ELN.query(payload)
+    facets = ELN.tag_facets(flask_login.current_user.id)
 
 
     results = [
-        {"nb" : (ELNNotebook.model_validate_json(res[1])), "id": res[0]} for res in notebooks_query.json()
+        {"nb" : ELNNotebookSummary.model_validate(res), "id": res["id"]} for res in notebooks_query["results"]
     ]
-    return flask.render_template("eln_index.jinja", results=results)
+    page = flask.render_template("eln_index.jinja", results=results, query=query, tags=tags, facets=facets, next_cursor=notebooks_query["next_cursor"])
+    PAGE_CACHE.set("eln_index", cache_key, page, generation)
+    return page
 
 
 @app.route("/eln/<int:id>")
@@ -161,14 +350,22 @@ def get_eln_index():
 def get_eln_detailed(id):
     """Get single notebook from the ELN server to view
     
-    Checks if the user is authorized to view it (user == current user or the notebook is public), raises a 405 if not"""
+    Checks if the user is authorized to view it (user == current user or the notebook is public), raises a 405 if not.
+    Pages are cached per user and notebook version"""
     
-    nb = _retrieve_notebook(id)
+    namespace, cache_key = f"eln_notebook/{id}", (flask_login.current_user.id,)
+    if (page := PAGE_CACHE.get(namespace, cache_key)) is not None:
+        return page
+
+    generation = PAGE_CACHE.generation(namespace)  # before fetching, so a concurrent write is not cached over
+    nb, etag = _retrieve_notebook(id)
     checkUserHasPermission(nb, flask_login.current_user)
-    return flask.render_template("eln_detailed.jinja", nb=nb, id=id)
+    page = flask.render_template("eln_detailed.jinja", nb=nb, id=id, etag=etag)
+    PAGE_CACHE.set(namespace, cache_key, page, generation)
+    return page
 
-@flask_login.login_required
 @app.route("/eln/new")
+@flask_login.login_required
 def get_eln_new():
     """Frontend action to create a new ELN via PUT request to the ELN server"""
     new_nb = ELNNotebook(
@@ -178,31 +375,78 @@ def get_eln_new():
         content="Im sad, nothing is written in me.."
     )
 
-    req = requests.put(ENDPOINT_ELN, json=new_nb.model_dump())
-    id = req.json().get("id")
+    id = ELN.create_notebook(new_nb)
+    _invalidate_pages()
     return flask.redirect(flask.url_for("get_eln_detailed", id=id))
 
-@flask_login.login_required
 @app.route("/eln/<int:id>/delete")
+@flask_login.login_required
 def get_eln_delete(id):
-    "Delete the ELN with this ID, redirect to the overview"
+    "Delete the ELN with this ID, redirect to the overview. The ELN server checks the user's permission in the same statement"
 
-    nb = _retrieve_notebook(id)
-    checkUserHasPermission(nb, flask_login.current_user)
-    requests.delete(ENDPOINT_ELN + f"{id}")
+    ELN.delete_notebook(id, user=flask_login.current_user.id)
+    _invalidate_pages(id)
     return flask.redirect(flask.url_for("get_eln_index"))
 
-@flask_login.login_required
+class ELN_Delta_Message_Model(ELNDelta):
+    """An autosave delta of the editor, see `eln_server.ELNDelta`"""
+    id: int
+    """Notebook the delta applies to"""
+    etag: Optional[str] = None
+    """Version the editor's content is based on; only sent with the first delta after a full save"""
+    flush: bool = False
+    """Write right away (e.g. the save button) instead of waiting for more deltas"""
+
+def _autosave_flushed(sid: str, id: int, etag: Optional[str], error: Optional[Exception]):
+    """Tell the editor how its autosave went: the new ETag, or the status of the failed write
+    (412: changed by someone else, 409: the editor's content diverged and has to be saved in full)"""
+    if error is None:
+        _invalidate_pages(id, etag)
+        socketio.emit("eln_autosave", {"id": id, "etag": etag}, to=sid)
+    else:
+        status, reason = (error.status_code, error.message) if isinstance(error, ELNError) else (500, str(error))
+        socketio.emit("eln_autosave", {"id": id, "status": status, "error": reason}, to=sid)
+
+ELN_AUTOSAVE = DeltaCoalescer(socketio,
+                              lambda id, delta, if_match, user: ELN.apply_delta(id, delta.model_dump(exclude_none=True), if_match=if_match, user=user),
+                              _autosave_flushed, flush_interval_s=ELN_AUTOSAVE_FLUSH_S)
+"Autosave deltas of all editors connected to this instance, written merged per editor and notebook"
+
+@socketio.on("eln_delta")
+def handle_eln_delta(message: dict):
+    """Queue an autosave delta of the editor. The acknowledgement only confirms the delta was queued,
+    the outcome of the write follows as `eln_autosave` event"""
+    if not flask_login.current_user.is_authenticated:
+        return {"status": 401}
+    try:
+        requestobj = ELN_Delta_Message_Model.model_validate(message)
+    except pydantic.ValidationError:
+        return {"status": 415}
+
+    delta = ELNDelta.model_validate(requestobj.model_dump(include=set(ELNDelta.model_fields)))
+    if not ELN_AUTOSAVE.add(flask.request.sid, requestobj.id, delta, flask_login.current_user.id,
+                            etag=requestobj.etag, flush=requestobj.flush):
+        # the version the delta applies to is unknown (new autosave, or a write failed): save in full first
+        return {"status": 428}
+    return {"status": "queued"}
+
 @app.route("/eln/<int:id>/update", methods=["POST"])
+@flask_login.login_required
 def post_eln_update(id):
-    """Update the provided ELN. The POST will be passed through to the PATCH method of the ELN in question"""
+    """Update the provided ELN. The POST will be passed through to the PATCH method of the ELN in question,
+    which checks the user's permission (401 if not) in the same statement as the write.
 
-    nb = _retrieve_notebook(id)
-    checkUserHasPermission(nb, flask_login.current_user)
+    An `If-Match` header is passed along, so edits based on an outdated version fail with a 412 instead of overwriting
+    someone else's changes. The new version is returned as `ETag`"""
+
+    etag = ELN.patch_notebook(id, flask.request.json, if_match=flask.request.headers.get("If-Match"),
+                              user=flask_login.current_user.id)
+    _invalidate_pages(id, etag)
 
-    requests.patch(ENDPOINT_ELN + f"{id}", json=flask.request.json)
-    return "saved"
+    response = flask.make_response("saved")
+    if etag: response.headers["ETag"] = etag
+    return response
 
 if __name__ == "__main__":
-    print(calc_sha512_hexdigest("apikeysarequiteexpensive"))
+    USERS.migrate()
     socketio.run(app, host="0.0.0.0", allow_unsafe_werkzeug=True)
\ No newline at end of file
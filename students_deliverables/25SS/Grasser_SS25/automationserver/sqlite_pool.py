@@ -0,0 +1,172 @@
+"""Small pooled connection manager for the SQLite stores
+
+Opening a connection per request is expensive (file open, schema parse, pragma setup) and throws away
+SQLite's per-connection prepared statement cache. The pool hands out long-lived connections instead,
+all configured for WAL journaling so readers never block the writer."""
+
+import contextlib
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from automationserver import tracing
+
+
+class PoolTimeout(Exception):
+    """No connection was returned to the pool within its `checkout_timeout_s`"""
+
+
+class TracedConnection(sqlite3.Connection):
+    """A connection that times every statement as span `sqlite.query`, labelled with the database and the kind of
+    statement (`SELECT`, `UPDATE`, ...). Only executing is timed, not fetching the rows of a returned cursor later"""
+
+    label = "sqlite"
+    "Database label of the spans"
+
+    def _span(self, sql: str):
+        return tracing.span("sqlite.query", db=self.label, op=sql.split(None, 1)[0].upper() if sql.strip() else "")
+
+    def execute(self, sql: str, parameters=(), /) -> sqlite3.Cursor:
+        with self._span(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters, /) -> sqlite3.Cursor:
+        with self._span(sql):
+            return super().executemany(sql, parameters)
+
+    def executescript(self, sql_script: str, /) -> sqlite3.Cursor:
+        with tracing.span("sqlite.query", db=self.label, op="SCRIPT"):
+            return super().executescript(sql_script)
+
+
+class SQLitePool:
+    """A bounded pool of SQLite connections shared by every route of an application.
+
+    Connections are created lazily, configured once and then reused. Werkzeug spawns a thread per request,
+    so connections are not bound to threads but checked out for the duration of a `with pool.connection()` block.
+    Statements executed with the same SQL string on a reused connection are served from sqlite3's statement
+    cache (`cached_statements`), i.e. they are only prepared once per connection."""
+
+    def __init__(self,
+                 path: str | pathlib.Path,
+                 max_connections: int = 8,
+                 synchronous: str = "NORMAL",
+                 cache_size_kib: int = 16384,
+                 busy_timeout_ms: int = 5000,
+                 cached_statements: int = 256,
+                 checkout_timeout_s: Optional[float] = None,
+                 on_connect: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.path = path
+        """Path to the database file"""
+        self.max_connections = max_connections
+        """Upper bound of simultaneously open connections; further checkouts block until one is returned"""
+        self.synchronous = synchronous
+        """`PRAGMA synchronous` - NORMAL is safe with WAL and avoids an fsync per transaction"""
+        self.cache_size_kib = cache_size_kib
+        """Page cache per connection in KiB"""
+        self.busy_timeout_ms = busy_timeout_ms
+        """How long a writer waits for the write lock before raising `database is locked`"""
+        self.cached_statements = cached_statements
+        """Size of the prepared statement cache per connection"""
+        self.checkout_timeout_s = checkout_timeout_s
+        """How long a checkout waits for a connection while all are in use before raising `PoolTimeout`, None to wait forever"""
+        self.on_connect = on_connect
+        """Optional hook run once for every new connection, e.g. to register SQL functions"""
+
+        self._label = pathlib.Path(path).stem
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open and configure a new connection"""
+        db = sqlite3.connect(self.path,
+                             autocommit=True,
+                             check_same_thread=False,
+                             cached_statements=self.cached_statements,
+                             factory=TracedConnection)
+        db.label = self._label
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA synchronous={self.synchronous}")
+        db.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        db.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        db.execute("PRAGMA temp_store=MEMORY")
+        if self.on_connect:
+            self.on_connect(db)
+        return db
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._open < self.max_connections:
+                self._open += 1
+                create = True
+            else:
+                create = False
+
+        if not create:
+            try:
+                return self._idle.get(timeout=self.checkout_timeout_s)
+            except queue.Empty:
+                raise PoolTimeout(f"No connection to {self._label} available within {self.checkout_timeout_s} s") from None
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+            raise
+
+    def _checkin(self, db: sqlite3.Connection):
+        if db.in_transaction:
+            # should not happen with `transaction()`, but never hand out a connection with a dangling transaction
+            db.rollback()
+        self._idle.put(db)
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Check out a connection (in autocommit mode) for the duration of the `with` block, raises `PoolTimeout` if none
+        becomes available in time.
+        Time spent waiting for and holding the connection is traced as `sqlite.wait` and `sqlite.hold`, each statement as
+        `sqlite.query`. The hold includes everything the block does meanwhile (e.g. validating a notebook in a transaction)"""
+        start = time.perf_counter()
+        db = self._checkout()
+        checked_out = time.perf_counter()
+        tracing.observe("sqlite.wait", checked_out - start, db=self._label)
+        try:
+            yield db
+        finally:
+            self._checkin(db)
+            tracing.observe("sqlite.hold", time.perf_counter() - checked_out, db=self._label)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Check out a connection and run the `with` block as one write transaction.
+
+        Commits on success and rolls back if the block raises. `BEGIN IMMEDIATE` takes the write lock upfront,
+        so concurrent writers wait for `busy_timeout_ms` instead of failing on lock upgrade."""
+        with self.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def close_all(self):
+        """Close all idle connections. Checked out connections are closed when the pool is garbage collected"""
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._open -= 1
@@ -1,36 +1,199 @@
-/** Gathers the entered information and sends it to the server, thus saving the notebook
+/** Autosave time after the last change, in ms */
+const NB_AUTOSAVE_DEBOUNCE_MS = 2000;
+/** Maximum autosave delay while changes keep coming in, in ms */
+const NB_AUTOSAVE_MAX_WAIT_MS = 10000;
+
+/** State of the autosave while editing, null if not active */
+let nbAutosave = null;
+
+
+/** Current title, visibility and content of the notebook as entered */
+function nbCurrentState() {
+    return {
+        public: (document.querySelector("select#publicprivate").value == "Public") ? true : false,
+        title: document.querySelector("input#nb-title-input").value,
+        content: document.querySelector("div#nb-content").innerHTML
+    };
+}
+
+
+/** Saves the notebook: the pending autosave right away if active, else the full content
  * 
  * @param {string} url_endpoint: the url endpoint (filled by jinja via url_for)
  */
 async function nbSave(url_endpoint){
+    if (nbAutosave) return nbAutosaveSend(true);
+    return nbSaveFull(url_endpoint);
+}
+
 
+/** Gathers the entered information and sends it to the server, thus saving the notebook
+ * 
+ * @param {string} url_endpoint: the url endpoint (filled by jinja via url_for)
+ * @param {object} payload: the state to save, by default the current one
+ * @returns {boolean} whether it was saved
+ */
+async function nbSaveFull(url_endpoint, payload = nbCurrentState()){
 
-    let publicprivate = (document.querySelector("select#publicprivate").value == "Public") ? true : false;
-    let title = document.querySelector("input#nb-title-input").value;
-    let content = document.querySelector("div#nb-content").innerHTML;
+    let content_div = document.querySelector("div#nb-content");
 
-    let payload = {
-        public: publicprivate,
-        title: title,
-        content: content
+    let headers = {
+        "Content-Type":"application/json"
     }
+    // only save on top of the version we started editing from
+    if (content_div.dataset.etag) headers["If-Match"] = content_div.dataset.etag;
 
     console.log(payload);
     request = await fetch(url_endpoint, {
         method: "POST",
         body: JSON.stringify(payload),
-        headers: {
-            "Content-Type":"application/json"
+        headers: headers
+    });
+
+    if (request.status == 412) {
+        alert("This notebook was changed by someone else in the meantime. Your changes were not saved - copy them and reload the page.");
+        return false;
+    }
+    if (request.headers.get("ETag")) content_div.dataset.etag = request.headers.get("ETag");
+    return request.ok;
+}
+
+
+/** The change from `before` to `after` as a single splice (common prefix and suffix are kept), null if equal.
+ * Positions count UTF-16 code units, like the ELN server; surrogate pairs are never split */
+function nbDiff(before, after) {
+    if (before == after) return null;
+    let start = 0;
+    let max_start = Math.min(before.length, after.length);
+    while (start < max_start && before.charCodeAt(start) == after.charCodeAt(start)) start++;
+    if (start > 0 && (before.charCodeAt(start - 1) & 0xFC00) == 0xD800) start--;
+
+    let end = 0;
+    let max_end = max_start - start;
+    while (end < max_end && before.charCodeAt(before.length - 1 - end) == after.charCodeAt(after.length - 1 - end)) end++;
+    if (end > 0 && (before.charCodeAt(before.length - end) & 0xFC00) == 0xDC00) end--;
+
+    return {start: start, delete: before.length - start - end, insert: after.substring(start, after.length - end)};
+}
+
+
+/** Starts autosaving the notebook being edited: changes are sent as deltas over Socket.IO, debounced.
+ * The first save of an edit session sends the full content, as the browser may have normalised the stored HTML
+ * 
+ * @param {string} url_endpoint: the url endpoint for full saves (filled by jinja via url_for)
+ */
+function nbStartAutosave(url_endpoint) {
+    let content_div = document.querySelector("div#nb-content");
+    nbAutosave = {
+        socket: io(),
+        url_endpoint: url_endpoint,
+        id: Number(content_div.dataset.id),
+        sent: null,        // state as last sent, null until saved in full
+        rebased: false,    // whether the server needs to be told the ETag the deltas apply to
+        in_flight: false,
+        flush_requested: false,
+        timer: null,
+        first_change: null
+    };
+
+    nbAutosave.socket.on("eln_autosave", (message) => {
+        if (!nbAutosave || message.id != nbAutosave.id) return;
+        if (message.etag) {
+            content_div.dataset.etag = message.etag;
+        } else if (message.status == 412) {
+            alert("This notebook was changed by someone else in the meantime. Your changes were not saved - copy them and reload the page.");
+            nbStopAutosave();
+        } else {
+            // the delta did not apply, save in full again
+            console.warn("Autosave failed:", message);
+            nbAutosave.sent = null;
+            nbScheduleAutosave();
         }
     });
 
+    let changed = () => nbScheduleAutosave();
+    content_div.addEventListener("input", changed);
+    document.querySelector("input#nb-title-input").addEventListener("input", changed);
+    document.querySelector("select#publicprivate").addEventListener("change", changed);
+}
+
+
+/** Stops autosaving, e.g. after a conflict */
+function nbStopAutosave() {
+    if (!nbAutosave) return;
+    clearTimeout(nbAutosave.timer);
+    nbAutosave.socket.disconnect();
+    nbAutosave = null;
+}
+
+
+/** Schedules an autosave after a change: once the editor is idle, but not later than the maximum wait */
+function nbScheduleAutosave() {
+    if (!nbAutosave) return;
+    let now = Date.now();
+    if (nbAutosave.first_change === null) nbAutosave.first_change = now;
+    let delay = Math.min(NB_AUTOSAVE_DEBOUNCE_MS, nbAutosave.first_change + NB_AUTOSAVE_MAX_WAIT_MS - now);
+    clearTimeout(nbAutosave.timer);
+    nbAutosave.timer = setTimeout(() => nbAutosaveSend(false), Math.max(0, delay));
+}
+
+
+/** Sends the changes since the last autosave
+ * 
+ * @param {boolean} flush: whether the server should write them right away
+ */
+async function nbAutosaveSend(flush) {
+    let state = nbAutosave;
+    if (!state) return;
+    if (state.in_flight) {
+        // sent once the current save is done
+        if (flush) state.flush_requested = true;
+        return nbScheduleAutosave();
+    }
+    clearTimeout(state.timer);
+    state.first_change = null;
+    let current = nbCurrentState();
+
+    state.in_flight = true;
+    if (state.sent === null) {
+        if (await nbSaveFull(state.url_endpoint, current)) {
+            state.sent = current;
+            state.rebased = true;
+        }
+        state.in_flight = false;
+        return;
+    }
+
+    let message = {id: state.id, length: current.content.length, flush: flush || state.flush_requested};
+    let splice = nbDiff(state.sent.content, current.content);
+    message.splices = splice ? [splice] : [];
+    if (current.title != state.sent.title) message.title = current.title;
+    if (current.public != state.sent.public) message.public = current.public;
+    if (state.rebased) message.etag = document.querySelector("div#nb-content").dataset.etag;
+    state.flush_requested = false;
+
+    state.socket.emit("eln_delta", message, (ack) => {
+        state.in_flight = false;
+        if (ack && ack.status == "queued") {
+            state.sent = current;
+            state.rebased = false;
+        } else {
+            // the server does not know which version the delta applies to (anymore), save in full
+            console.warn("Autosave rejected:", ack);
+            state.sent = null;
+            return nbScheduleAutosave();
+        }
+        if (nbCurrentState().content != current.content) nbScheduleAutosave();
+    });
 }
 
 
 /**
- * Switches the detailed notebook view over to edit mode
+ * Switches the detailed notebook view over to edit mode, with autosave
+ * 
+ * @param {string} url_endpoint: the url endpoint for saving (filled by jinja via url_for)
  */
-function nbSwitchToEdit() {
+function nbSwitchToEdit(url_endpoint) {
 
     document.querySelector("button#btn-edit").style.display = "none";
     document.querySelector("button#btn-save").style.display = "inline-block";
@@ -38,4 +201,5 @@ function nbSwitchToEdit() {
     document.querySelector("#nb-title").style.display = "none";
     document.querySelector("input#nb-title-input").style.display = "inline-block";
     window.__tinyEditor.transformToEditor(document.querySelector("#nb-content"));
+    nbStartAutosave(url_endpoint);
 }
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""Request tracing and timing histograms, shared by the frontend and the ELN server
+
+Every request gets an ID - taken from the `X-Request-ID` header if the caller sent one, so a frontend request and the
+ELN API calls it causes share one ID - which is echoed in the response and passed on by `eln_client`.
+Code sections are timed with `span()`; durations are aggregated into histograms per span name and labels, exposed in
+the Prometheus text format by `metrics_response()`, and summed up per request in a `Server-Timing` response header
+(visible in the browser's developer tools).
+
+Recorded spans: `http.server` (whole requests), `http.client` (calls to the ELN server), `sqlite.wait` / `sqlite.hold`
+(waiting for and holding a pooled connection, the hold including any work done meanwhile), `sqlite.query` (executing
+one statement, by kind), `validate` (pydantic) and `render` (Jinja templates)."""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+import uuid
+from typing import Iterator, Optional
+
+import flask
+
+REQUEST_ID_HEADER = "X-Request-ID"
+"Header carrying the request ID across services"
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"Upper bounds of the histogram buckets in seconds"
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_request_spans: contextvars.ContextVar[Optional[dict[str, float]]] = contextvars.ContextVar("request_spans", default=None)
+
+
+class Histogram:
+    """Counts of durations per bucket, plus their sum"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        """Observations per bucket, the last one for everything above the highest bound"""
+        self.sum = 0.0
+        """Sum of all observed durations"""
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+
+_histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram] = {}
+_lock = threading.Lock()
+
+
+def request_id() -> Optional[str]:
+    """ID of the request being handled, None outside of requests"""
+    return _request_id.get()
+
+
+def observe(name: str, seconds: float, **labels: str):
+    """Record a duration of span `name`; also counted towards the current request's `Server-Timing`"""
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+    if (spans := _request_spans.get()) is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def span(name: str, **labels: str) -> Iterator[None]:
+    """Time the enclosed block as span `name`. Labels should have few distinct values (no IDs), each combination is a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def instrument_app(app: flask.Flask):
+    """Assign request IDs and time requests and template rendering of `app`"""
+
+    @app.before_request
+    def _start_trace():
+        flask.g.trace_tokens = (_request_id.set(flask.request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex),
+                                _request_spans.set({}))
+        flask.g.trace_start = time.perf_counter()
+
+    @app.after_request
+    def _finish_trace(response: flask.Response) -> flask.Response:
+        if not hasattr(flask.g, "trace_start"): return response
+        observe("http.server", time.perf_counter() - flask.g.trace_start,
+                endpoint=flask.request.endpoint or "unknown", method=flask.request.method, status=response.status_code)
+        response.headers[REQUEST_ID_HEADER] = request_id()
+        if (spans := _request_spans.get()):
+            response.headers["Server-Timing"] = ", ".join(f"{name.replace('.', '-')};dur={seconds * 1000:.2f}"
+                                                          for name, seconds in spans.items() if name != "http.server")
+        return response
+
+    @app.teardown_request
+    def _end_trace(exc):
+        if (tokens := flask.g.pop("trace_tokens", None)):
+            _request_id.reset(tokens[0])
+            _request_spans.reset(tokens[1])
+
+    def _render_started(sender, template, context, **extra):
+        flask.g.render_start = time.perf_counter()
+
+    def _render_finished(sender, template, context, **extra):
+        if (start := flask.g.pop("render_start", None)) is not None:
+            observe("render", time.perf_counter() - start, template=template.name or "string")
+
+    flask.before_render_template.connect(_render_started, app, weak=False)
+    flask.template_rendered.connect(_render_finished, app, weak=False)
+
+
+def metrics_response() -> flask.Response:
+    """All histograms in the Prometheus text exposition format"""
+    with _lock:
+        snapshot = [(name, labels, list(histogram.counts), histogram.sum) for (name, labels), histogram in sorted(_histograms.items())]
+
+    escape = lambda value: value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    lines = ["# TYPE span_seconds histogram"]
+    for name, labels, counts, total in snapshot:
+        label_text = ",".join([f'span="{name}"'] + [f'{label}="{escape(value)}"' for label, value in labels])
+        cumulative = 0
+        for bound, count in zip([*map(str, BUCKETS), "+Inf"], counts):
+            cumulative += count
+            lines.append(f'span_seconds_bucket{{{label_text},le="{bound}"}} {cumulative}')
+        lines.append(f"span_seconds_sum{{{label_text}}} {total}")
+        lines.append(f"span_seconds_count{{{label_text}}} {cumulative}")
+    return flask.Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
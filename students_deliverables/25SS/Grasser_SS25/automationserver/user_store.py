@@ -0,0 +1,206 @@
+"""User accounts of the frontend: lookup, password verification and password hashing
+
+Passwords are hashed with scrypt, a salted and memory hard KDF. Its cost is tunable (`USER_SCRYPT_N`); hashes store
+their parameters, so raising the cost upgrades existing hashes on the next login. Accounts still holding an unsalted
+SHA-512 hexdigest (the original scheme) are migrated to scrypt on their next successful login, too.
+
+Hashing runs on a small worker pool: a burst of logins costs at most `hash_workers` cores instead of stalling every
+request thread. User records are cached in memory for `USER_CACHE_TTL_S`, and invalidated whenever this store changes
+them; changes made by other processes (the command line below, other instances) take effect after at most that time.
+
+Usage (no frontend user management):
+
+    python -m automationserver.user_store migrate
+    python -m automationserver.user_store add <username>
+    python -m automationserver.user_store set-password <username>"""
+
+import argparse
+import base64
+import concurrent.futures
+import functools
+import getpass
+import hashlib
+import hmac
+import os
+import pathlib
+import secrets
+import sys
+import time
+from typing import NamedTuple, Optional
+
+from automationserver.cache import LRUCache
+from automationserver.sqlite_pool import SQLitePool
+
+
+USER_DB_PATH = pathlib.Path(db_path) if (db_path := os.environ.get("USER_DB_PATH")) else pathlib.Path(__file__).parent / "store" / "user_db.sqlite"
+"Location of the user database; defaults to the bundled store, can be overridden by the environment"
+
+USER_CACHE_TTL_S = float(os.environ.get("USER_CACHE_TTL_S", 5))
+"Maximum age of a cached user record, bounds how long a password changed by another process keeps working"
+
+SCRYPT_N = int(os.environ.get("USER_SCRYPT_N", 2**14))
+"scrypt CPU/memory cost of new hashes (a power of two); memory use is about 128 * N * 8 bytes per hash"
+
+MIGRATIONS: list[str] = [
+    # 1: the original table
+    """
+    CREATE TABLE IF NOT EXISTS users(id INTEGER PRIMARY KEY, username TEXT, sha512 TEXT);
+    """,
+
+    # 2: scrypt hashes replace the unsalted sha512 column, which is cleared once migrated
+    """
+    ALTER TABLE users ADD COLUMN password_hash TEXT;
+    CREATE INDEX users_username ON users(username);
+    """,
+]
+
+
+def legacy_sha512_hexdigest(password: str) -> str:
+    """The unsalted SHA-512 hexdigest of the original scheme, only used to verify not yet migrated accounts"""
+    return hashlib.sha512(password.encode()).hexdigest()
+
+
+def hash_password(password: str, n: Optional[int] = None, r: int = 8, p: int = 1) -> str:
+    """Hash `password` with scrypt and a random salt (`n` defaults to `SCRYPT_N`).
+    The result carries its parameters: `scrypt$n$r$p$salt$hash`"""
+    n = n or SCRYPT_N
+    salt = secrets.token_bytes(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+    return "$".join(["scrypt", str(n), str(r), str(p), base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check `password` against a hash from `hash_password`, in constant time"""
+    try:
+        scheme, n, r, p, salt, key = password_hash.split("$")
+        n, r, p = int(n), int(r), int(p)
+    except ValueError:
+        return False
+    if scheme != "scrypt": return False
+    expected = base64.b64decode(key)
+    actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=len(expected))
+    return hmac.compare_digest(actual, expected)
+
+
+def _needs_rehash(password_hash: str) -> bool:
+    """Whether a hash was made with weaker parameters than the current ones"""
+    return not password_hash.startswith(f"scrypt${SCRYPT_N}$8$1$")
+
+
+class UserRecord(NamedTuple):
+    """A user account as stored"""
+    id: int
+    """Row ID"""
+    username: str
+    """Login name, used as user ID throughout the application"""
+    sha512: Optional[str]
+    """Unsalted SHA-512 hexdigest of the original scheme, None once migrated"""
+    password_hash: Optional[str]
+    """scrypt hash, see `hash_password`"""
+
+
+class UserStore:
+    """Pooled, cached access to the user database"""
+
+    def __init__(self, path: str | pathlib.Path = USER_DB_PATH, cache_size: int = 1024, hash_workers: int = 2,
+                 cache_ttl_s: float = USER_CACHE_TTL_S):
+        self.pool = SQLitePool(path, max_connections=4)
+        """Connections to the user database"""
+        self.cache = LRUCache(cache_size)
+        """`(expires, record)` by username; only existing users are cached"""
+        self.cache_ttl_s = cache_ttl_s
+        """Maximum age of a cached record (monotonic time)"""
+        self.hashers = concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="password-hash")
+        """Workers running the password KDF"""
+
+    @functools.cached_property
+    def _dummy_hash(self) -> str:
+        """Verified against for unknown usernames, so they take as long as known ones. Made on first use, not on startup"""
+        return hash_password(secrets.token_hex(16))
+
+    def migrate(self):
+        """Create or migrate the database scheme, if necessary. Safe to run from several starting instances at once"""
+        with self.pool.connection() as db:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    # another instance may have migrated while this one waited for the write lock
+                    if db.execute("PRAGMA user_version").fetchone()[0] < target:
+                        db.executescript(f"{script}; PRAGMA user_version = {target};")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+
+    def get(self, username: str) -> Optional[UserRecord]:
+        """The record of `username`, None if there is no such user. Cached for up to `cache_ttl_s`"""
+        entry = self.cache.get(username)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        with self.pool.connection() as db:
+            fetchres = db.execute("SELECT id, username, sha512, password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        if not fetchres:
+            self.cache.delete(username)
+            return None
+        record = UserRecord(*fetchres)
+        self.cache.set(username, (time.monotonic() + self.cache_ttl_s, record))
+        return record
+
+    def add(self, username: str, password: str) -> UserRecord:
+        """Create a user. Raises a ValueError if the username is taken"""
+        password_hash = self.hashers.submit(hash_password, password).result()
+        with self.pool.transaction() as db:
+            if db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                raise ValueError(f"User {username} exists already")
+            id = db.execute("INSERT INTO users(username, password_hash) VALUES (?, ?)", (username, password_hash)).lastrowid
+        self.cache.delete(username)
+        return UserRecord(id, username, None, password_hash)
+
+    def set_password(self, username: str, password: str):
+        """Store a new scrypt hash of `password` for `username`, dropping any legacy hash"""
+        password_hash = self.hashers.submit(hash_password, password).result()
+        with self.pool.connection() as db:
+            db.execute("UPDATE users SET password_hash = ?, sha512 = NULL WHERE username = ?", (password_hash, username))
+        self.cache.delete(username)
+
+    def authenticate(self, username: str, password: str) -> Optional[UserRecord]:
+        """The user's record if `password` is correct, else None. Upgrades legacy or outdated hashes on success"""
+        record = self.get(username) if username else None
+
+        if record is None or not (record.password_hash or record.sha512):
+            self.hashers.submit(verify_password, password, self._dummy_hash).result()
+            return None
+
+        if record.password_hash:
+            if not self.hashers.submit(verify_password, password, record.password_hash).result(): return None
+            if _needs_rehash(record.password_hash): self.set_password(username, password)
+        else:
+            if not hmac.compare_digest(legacy_sha512_hexdigest(password), record.sha512): return None
+            self.set_password(username, password)
+
+        return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the users of the frontend")
+    parser.add_argument("command", choices=["migrate", "add", "set-password"])
+    parser.add_argument("username", nargs="?")
+    args = parser.parse_args()
+    if args.command != "migrate" and not args.username: parser.error(f"{args.command} needs a username")
+
+    store = UserStore()
+    store.migrate()
+    if args.command == "migrate": sys.exit()
+    password = getpass.getpass(f"Password for {args.username}: ")
+
+    if args.command == "add":
+        try:
+            store.add(args.username, password)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif store.get(args.username) is None:
+        sys.exit(f"No user {args.username}")
+    else:
+        store.set_password(args.username, password)
+    print(f"{args.command}: {args.username}", file=sys.stderr)
@@ -1,19 +1,194 @@
 """class simulating a pH meter"""
 
-import random
+import functools
+import threading
+import time
+from typing import NamedTuple, Optional, Sequence
 import numpy as np
+import numpy.typing as npt
+
+NAOH_MOL_PER_ML = 0.10 / 40
+"Moles of NaOH per mL of titrant, assuming 10% w/w NaOH"
+
+SAMPLE_VOLUME_ML = 1000.0
+"Volume of the titrated solution before titration"
+
+PKW = 14.0
+"Negative decadic logarithm of the ion product of water (25 °C)"
+
+_LN10 = np.log(10)
+
+def pH_curve(volumes_mL: npt.ArrayLike, pka: npt.ArrayLike, acid_conc_M: float = 1.0,
+             sample_volume_mL: float = SAMPLE_VOLUME_ML, titrant_conc_M: float = NAOH_MOL_PER_ML * 1000,
+             pkw: float = PKW, noise_sd: float = 0.0, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Calculates the pH for many added volumes and monoprotic acids at once, exactly from the charge balance
+    (see `TitrationModel`, which also handles polyprotic acids)
+
+    For one pKa, the charge balance is a cubic in [H+] with a single positive root. It is convex for [H+] > 0, so
+    Newton's method started above the root converges monotonically; the start is a tight upper bound from the
+    quadratics neglecting either water or the weak acid's equilibrium, leaving one or two steps for most points.
+
+    Args:
+        volumes_mL: added volumes of titrant
+        pka: a pKa, or a 1D batch of pKas - giving one curve per pKa
+        acid_conc_M: concentration of the acid before titration, mol/L
+        sample_volume_mL: volume of the solution before titration
+        titrant_conc_M: concentration of the base in the titrant, mol/L
+        pkw: pKw of water
+        noise_sd: standard deviation of the simulated readout noise, 0 for the exact curve
+        rng: random generator for the noise
+
+    Returns:
+        np.ndarray: the pHs, shaped like `volumes_mL` - prefixed by the batch dimension if `pka` is a batch"""
+
+    volumes = np.asarray(volumes_mL, dtype=np.float64)
+    pka = np.asarray(pka, dtype=np.float64)
+    if pka.ndim: pka = pka.reshape(pka.shape + (1,) * volumes.ndim)
+    shape = np.broadcast_shapes(pka.shape, volumes.shape)
+
+    # diluted concentrations per volume, constants per pKa
+    total_volume = sample_volume_mL + volumes
+    acid = acid_conc_M * sample_volume_mL / total_volume
+    base = titrant_conc_M * volumes / total_volume
+    excess = base - acid
+    ka, kw = 10.0**-pka, 10.0**-pkw
+
+    # h^3 + a h^2 + b h + c = 0
+    a = np.broadcast_to(ka + base, shape)
+    b = np.broadcast_to(ka * excess - kw, shape)
+    c = np.broadcast_to(-kw * ka, shape)
+
+    # upper bounds of h: the acid fully dissociated, and (before the equivalence point) the bound following from
+    # the lower bound that neglects water
+    h = np.broadcast_to(2 * kw / (excess + np.sqrt(excess * excess + 4 * kw)), shape).copy()
+    before = np.broadcast_to(excess < 0, shape)
+    if before.any():
+        a_before, ka_excess = a[before], np.broadcast_to(ka * excess, shape)[before]
+        lower = -2 * ka_excess / (a_before + np.sqrt(a_before * a_before - 4 * ka_excess))
+        shift = kw / lower
+        linear, constant = a_before - shift, ka_excess - np.broadcast_to(ka, shape)[before] * shift
+        h[before] = np.minimum(h[before], -2 * constant / (linear + np.sqrt(linear * linear - 4 * constant)))
+
+    flat_h, flat_a, flat_b, flat_c = h.reshape(-1), a.reshape(-1), b.reshape(-1), c.reshape(-1)
+    active = slice(None)
+    for _ in range(100):
+        hs, as_ = flat_h[active], flat_a[active]
+        step = (((hs + as_) * hs + flat_b[active]) * hs + flat_c[active]) / ((3 * hs + 2 * as_) * hs + flat_b[active])
+        hs -= step
+        flat_h[active] = hs
+        # only the points that have not converged yet take another step
+        unconverged = step > 1e-12 * hs
+        if not unconverged.any(): break
+        active = np.flatnonzero(unconverged) if isinstance(active, slice) else active[unconverged]
+
+    pH = np.negative(np.log10(h, out=h), out=h)
+    if noise_sd:
+        rng = rng or np.random.default_rng()
+        noise = rng.standard_normal(pH.shape)
+        noise *= noise_sd
+        pH += noise
+    return pH
+
+class TitrationModel:
+    """Titration of a (polyprotic) weak acid with a strong base, solved exactly from the charge balance
+
+        [H+] + [Na+] = [OH-] + c_acid * n(pH)
+
+    with n the mean number of protons the acid gave off, from its pKas, and both concentrations diluted by the added
+    titrant. Solved for the added volume instead of the pH, this has a closed form, `volume_at(pH)`. The model
+    tabulates it once over a pH grid; `pH(volumes)` then only interpolates that table. Models are immutable, get them
+    from `titration_model` to share the table between equal setups. For many monoprotic acids at once, `pH_curve`
+    solves the charge balance directly instead."""
+
+    def __init__(self, pkas: Sequence[float], acid_conc_M: float, sample_volume_mL: float, titrant_conc_M: float,
+                 pkw: float = PKW, grid_points: int = 4096):
+        self.pkas = tuple(pkas)
+        """pKas of the acid, in order of dissociation"""
+        self.acid_conc_M = acid_conc_M
+        """Concentration of the acid before titration, mol/L"""
+        self.sample_volume_mL = sample_volume_mL
+        """Volume of the solution before titration"""
+        self.titrant_conc_M = titrant_conc_M
+        """Concentration of the base in the titrant, mol/L"""
+        self.pkw = pkw
+        """pKw of water"""
+
+        # cumulative dissociation constants log10(Ka1 * ... * Kaj) per species, j protons given off
+        self._log_beta = -np.concatenate([[0.0], np.cumsum(self.pkas)])
+        self._protons = np.arange(len(self.pkas) + 1, dtype=np.float64)
+
+        # the volume is valid where it is positive and the titrant can still raise the pH (not yet saturated)
+        pH = np.linspace(-1, pkw + 1, grid_points)
+        volume = self.volume_at(pH)
+        valid = np.isfinite(volume) & (volume > 0) & (self._titrant_excess(pH) > 0)
+        self._grid_pH, self._grid_volume = pH[valid], volume[valid]
+        start = self.pH(0.0, polish=8)
+        self._grid_pH = np.concatenate([[start], self._grid_pH])
+        self._grid_volume = np.concatenate([[0.0], self._grid_volume])
+
+    @property
+    def equivalence_volumes_mL(self) -> np.ndarray:
+        """Titrant volumes to reach each equivalence point"""
+        return self._protons[1:] * self.acid_conc_M * self.sample_volume_mL / self.titrant_conc_M
+
+    def _titrant_excess(self, pH: np.ndarray) -> np.ndarray:
+        return self.titrant_conc_M + 10.0**-pH - 10.0**(pH - self.pkw)
+
+    def _protons_given_off(self, pH: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Mean and variance of the number of protons given off per acid molecule"""
+        log_weight = self._log_beta + np.multiply.outer(pH, self._protons)
+        log_weight -= log_weight.max(axis=-1, keepdims=True)
+        weight = 10.0**log_weight
+        total = weight.sum(axis=-1)
+        mean = (weight @ self._protons) / total
+        return mean, (weight @ self._protons**2) / total - mean**2
+
+    def volume_at(self, pH: npt.ArrayLike) -> np.ndarray:
+        """Titrant volume at which `pH` is reached (negative or infinite where it never is)"""
+        pH = np.asarray(pH, dtype=np.float64)
+        h, oh = 10.0**-pH, 10.0**(pH - self.pkw)
+        mean, _ = self._protons_given_off(pH)
+        with np.errstate(divide="ignore"):
+            return self.sample_volume_mL * (self.acid_conc_M * mean - h + oh) / (self.titrant_conc_M + h - oh)
+
+    def pH(self, volumes_mL: npt.ArrayLike, polish: int = 0) -> np.ndarray:
+        """The pH after adding `volumes_mL` titrant. Interpolating the table is exact to about 1e-5 pH;
+        each `polish` step (Newton's method on the charge balance) roughly squares the error, but costs ~20x more"""
+        volumes = np.asarray(volumes_mL, dtype=np.float64)
+        pH = np.interp(volumes, self._grid_volume, self._grid_pH)
+        for _ in range(polish):
+            h, oh = 10.0**-pH, 10.0**(pH - self.pkw)
+            mean, variance = self._protons_given_off(pH)
+            numerator = self.acid_conc_M * mean - h + oh
+            denominator = self.titrant_conc_M + h - oh
+            slope = self.sample_volume_mL * _LN10 * ((self.acid_conc_M * variance + h + oh) * denominator
+                                                     + numerator * (h + oh)) / denominator**2
+            pH = pH - (self.sample_volume_mL * numerator / denominator - volumes) / slope
+        return pH
+
+@functools.lru_cache(maxsize=256)
+def titration_model(pkas: tuple[float, ...], acid_conc_M: float, sample_volume_mL: float, titrant_conc_M: float) -> TitrationModel:
+    """The `TitrationModel` of a setup, shared by all callers with the same setup"""
+    return TitrationModel(pkas, acid_conc_M, sample_volume_mL, titrant_conc_M)
 
 class pHMeter:
     """A simulated pHMeter.
     
-    Simulates titration of 1 mol of a randomized pKa with 10% w/w NaOH.
+    Simulates titration of 1 mol of an acid with a randomized pKa in 1 L with 10% w/w NaOH, see `TitrationModel`.
     
-    provides a `readout` property to get the current readout, and an `add()` function to simulate titration"""
-    def __init__(self):
-        self.pka = random.randint(1,5)
+    provides a `readout` property to get the current readout, and an `add()` function to simulate titration.
+    Its randomness (pKa and noise) comes from its own generator: meters with the same `seed` behave the same"""
+    def __init__(self, seed: Optional[int | np.random.SeedSequence] = None):
+        self.rng = np.random.default_rng(seed)
+        """Random generator of this meter, seeded with `seed` (unpredictably if None)"""
+        self.pka = int(self.rng.integers(1, 5, endpoint=True))
         """Initial pKa for the titration, randomized"""
         self.moles_to_titrate = 1
         """Config value - how much there is to titrate"""
+        self.sample_volume_mL = SAMPLE_VOLUME_ML
+        """Config value - volume of the solution to titrate"""
+        self.titrant_conc_M = NAOH_MOL_PER_ML * 1000
+        """Config value - concentration of the NaOH titrant, mol/L"""
         self.added_volume_mL = 0.0
         """How much titer was added"""
         self.tau = 0
@@ -25,19 +200,42 @@ class pHMeter:
 
     @property
     def pH(self) -> float:
-        """Calculates the pH from the pkA, the added volume and the Hendersson-Hasselbach equation
+        """Calculates the pH from the pkA and the added volume, from the charge balance (see `TitrationModel`)
                 
         Returns:
             float: the current calculated pH"""
 
-        added_moles = self.added_volume_mL * 0.10 / 40
-        """Assuming titration with 10% w/w NaOH"""
-        self.tau = added_moles / 1 if added_moles != 0 else 0
+        added_moles = self.added_volume_mL * self.titrant_conc_M / 1000
+        self.tau = added_moles / self.moles_to_titrate
         """association quotient"""
 
-        if self.tau == 0: return self.pka * 0.1
-        elif self. tau > 1: return (pH := 14 - (self.pka + np.log10(np.abs(self.tau/(1-self.tau)))))
-        else: return (pH:= self.pka + np.log10(np.abs(self.tau/(1-self.tau))))
+        return float(self.model().pH(self.added_volume_mL))
+
+    def model(self, pka: Optional[float] = None) -> TitrationModel:
+        """The titration model of the meter's setup, with its own pKa or `pka`"""
+        return titration_model((float(self.pka if pka is None else pka),), self.moles_to_titrate * 1000 / self.sample_volume_mL,
+                               self.sample_volume_mL, self.titrant_conc_M)
+
+    def curve(self, volumes_mL: npt.ArrayLike, pka: Optional[npt.ArrayLike] = None, noise_sd: float = 0.01) -> np.ndarray:
+        """The readouts for many added volumes at once, without changing the meter
+
+        Args:
+            volumes_mL: added volumes of titrant
+            pka: a pKa or a batch of pKas, by default the meter's
+            noise_sd: standard deviation of the readout noise, 0 for the exact pH
+
+        Returns:
+            np.ndarray: the readouts"""
+
+        if pka is None or np.ndim(pka) == 0:
+            pH = self.model(pka).pH(volumes_mL)
+        else:
+            # a table per pKa would not pay off (nor fit the model cache), the batch is solved directly
+            return pH_curve(volumes_mL, pka, self.moles_to_titrate * 1000 / self.sample_volume_mL,
+                            self.sample_volume_mL, self.titrant_conc_M, noise_sd=noise_sd, rng=self.rng)
+        if noise_sd:
+            pH += noise_sd * self.rng.standard_normal(pH.shape)
+        return pH
     
     @property
     def readout(self) -> float:
@@ -46,11 +244,338 @@ class pHMeter:
         Returns:
             float: the randomized pH readout"""
         
-        return random.gauss(self.pH, 0.01)
+        return float(self.rng.normal(self.pH, 0.01))
+
+
+
+class SampleRingBuffer:
+    """Fixed size history of multi-channel samples, the oldest are overwritten
+
+    Every sample is stored twice, at `i % capacity` and `i % capacity + capacity`, so the latest samples are always one
+    contiguous slice: windows are views, not copies. Views are read-only and stay valid until `capacity - n` more
+    samples were written - copy them to keep them longer."""
+
+    def __init__(self, capacity: int, channels: int):
+        self.capacity = capacity
+        """Number of samples kept"""
+        self.total = 0
+        """Number of samples written so far, including overwritten ones"""
+        self._data = np.zeros((channels, 2 * capacity))
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def extend(self, samples: np.ndarray):
+        """Append samples, shaped (channels, n)"""
+        count = samples.shape[1]
+        samples = samples[:, -self.capacity:]
+        n = samples.shape[1]
+        start = (self.total + count - n) % self.capacity
+        first = min(n, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._data[:, offset + start:offset + start + first] = samples[:, :first]
+            self._data[:, offset:offset + n - first] = samples[:, first:]
+        # published last, so readers never see samples that are not written yet
+        self.total += count
+
+    def window(self, n: Optional[int] = None) -> np.ndarray:
+        """View of the latest `n` samples (all if None), oldest first, shaped (channels, n)"""
+        n = len(self) if n is None else min(n, len(self))
+        end = self.total % self.capacity + self.capacity
+        view = self._data[:, end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def downsampled(self, points: int, n: Optional[int] = None) -> np.ndarray:
+        """The latest `n` samples (all if None) averaged into at most `points` buckets, shaped (channels, points).
+        For plain decimation without averaging, slice the window instead: `window(n)[:, ::step]` is a view, too"""
+        window = self.window(n)
+        per_point = window.shape[1] // points
+        if per_point <= 1: return window
+        # the oldest samples not filling a whole bucket are left out
+        window = window[:, window.shape[1] - per_point * points:]
+        return window.reshape(window.shape[0], points, per_point).mean(axis=2)
+
+
+class pHSensorStream:
+    """Readouts of a `pHMeter`, sampled at a fixed rate into a `SampleRingBuffer`
+
+    Samples are produced in blocks: `fill()` generates all samples due since its last call in one vectorized step.
+    `start()` calls it every `block_interval_s` from a background thread; without, call `fill()` before reading the
+    history and before changing the meter, which produces the same samples on demand."""
+
+    TIME, VOLUME, PH = range(3)
+    """Channels of the history: seconds since the stream started, added volume in mL, and the pH readout"""
+
+    def __init__(self, meter: pHMeter, rate_hz: float = 1000.0, capacity: int = 2**16,
+                 noise_sd: float = 0.01, block_interval_s: float = 0.05):
+        self.meter = meter
+        """The sampled pH meter"""
+        self.rate_hz = rate_hz
+        """Samples per second"""
+        self.noise_sd = noise_sd
+        """Standard deviation of the readout noise"""
+        self.block_interval_s = block_interval_s
+        """Time between two blocks of the background thread"""
+        self.history = SampleRingBuffer(capacity, 3)
+        """The latest samples, see `TIME`, `VOLUME` and `PH` for the channels"""
+
+        self._start = time.monotonic()
+        self._produced = 0
+        # a generator of its own, derived from the meter's: reproducible without interleaving with the meter's draws
+        self._rng = meter.rng.spawn(1)[0]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def fill(self) -> int:
+        """Produce all samples due by now, returns how many. Samples lost for lack of capacity are skipped"""
+        with self._lock:
+            due = int((time.monotonic() - self._start) * self.rate_hz)
+            first = max(self._produced, due - self.history.capacity)
+            n = due - first
+            if n <= 0: return 0
+
+            block = np.empty((3, n))
+            np.divide(np.arange(first, due), self.rate_hz, out=block[self.TIME])
+            # the meter only changes between blocks, so the exact pH is the same for the whole block
+            block[self.VOLUME] = self.meter.added_volume_mL
+            self._rng.standard_normal(out=block[self.PH])
+            block[self.PH] *= self.noise_sd
+            block[self.PH] += self.meter.pH
+
+            self.history.extend(block)
+            self._produced = due
+            return n
+
+    def recent(self, seconds: float) -> np.ndarray:
+        """View of the samples of the last `seconds`, see `SampleRingBuffer.window`"""
+        return self.history.window(int(seconds * self.rate_hz))
+
+    def start(self):
+        """Produce samples continuously in a background thread"""
+        if self._thread is not None: return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pH-sensor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        if self._thread is None: return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.block_interval_s):
+            self.fill()
+
+
+
+class EndpointDetector:
+    """Online detection of the equivalence point, from (volume, pH) readouts in the order they are taken
+
+    Every update costs O(1): readouts at the same volume are averaged, and a parabola through the last three volumes
+    gives the slope dpH/dV and the curvature at the middle one. The endpoint is the inflection of the curve, where the
+    curvature turns from positive to negative at a slope peak; its volume is interpolated from the curvatures on both
+    sides. Of several inflections (polyprotic acids) the steepest is reported.
+
+    The confidence (0 to 1) is how much the peak slope stands out from the mean slope before it, times how far the
+    slope has fallen since (full at half the peak) - a steep, passed jump scores high, noise wiggles score low."""
+
+    def __init__(self):
+        self.slope: Optional[float] = None
+        """Slope dpH/dV at the latest volume but one, None until three volumes were read"""
+        self.curvature: Optional[float] = None
+        """Curvature d2pH/dV2 at the same volume"""
+        self.endpoint_mL: Optional[float] = None
+        """Volume of the endpoint, None until one was passed"""
+        self.confidence = 0.0
+        """Confidence in `endpoint_mL`"""
+        self.reset()
+
+    def reset(self):
+        """Forget all readouts, e.g. for a new titration"""
+        self.slope = self.curvature = self.endpoint_mL = None
+        self.confidence = 0.0
+        self._points: list[list[float]] = []
+        """Up to the last three volumes: volume, mean pH, number of readouts"""
+        self._previous: Optional[tuple[float, float, float]] = None
+        """Volume, slope and curvature at the previous middle volume"""
+        self._slope_sum = 0.0
+        self._slope_count = 0
+        self._candidate: Optional[tuple[float, float, float]] = None
+        """Inflection at the current middle volume, until it is final: volume, peak slope, baseline slope"""
+        self._endpoint: Optional[tuple[float, float, float]] = None
+        """Steepest final inflection: volume, peak slope, baseline slope"""
+
+    def update(self, volume_mL: float, pH: float) -> dict:
+        """Add a readout, returns the current `state()`"""
+        points = self._points
+        if points and volume_mL == points[-1][0]:
+            point = points[-1]
+            point[2] += 1
+            point[1] += (pH - point[1]) / point[2]
+        else:
+            if points and volume_mL < points[-1][0]:
+                self.reset()
+                points = self._points
+            if len(points) == 3: self._shift()
+            points.append([volume_mL, pH, 1])
+        if len(points) == 3: self._estimate()
+        return self.state()
+
+    def _shift(self):
+        """The middle volume's estimates are final once a later volume is read"""
+        if self._candidate and (self._endpoint is None or self._candidate[1] > self._endpoint[1]):
+            self._endpoint = self._candidate
+        self._previous = (self._points[1][0], self.slope, self.curvature)
+        self._slope_sum += self.slope
+        self._slope_count += 1
+        self._points.pop(0)
+
+    def _estimate(self):
+        """Slope and curvature at the middle volume, and whether an inflection lies just before it"""
+        (x0, y0, _), (x1, y1, _), (x2, y2, _) = self._points
+        slope_before, slope_after = (y1 - y0) / (x1 - x0), (y2 - y1) / (x2 - x1)
+        # derivatives of the parabola through the three points, at the middle one
+        self.slope = (slope_before * (x2 - x1) + slope_after * (x1 - x0)) / (x2 - x0)
+        self.curvature = 2 * (slope_after - slope_before) / (x2 - x0)
+
+        self._candidate = None
+        if self._previous:
+            volume, slope, curvature = self._previous
+            if curvature > 0 >= self.curvature and max(slope, self.slope) > 0:
+                baseline = self._slope_sum / self._slope_count
+                self._candidate = (volume + (x1 - volume) * curvature / (curvature - self.curvature),
+                                   max(slope, self.slope), baseline)
+
+        endpoint = self._endpoint
+        if self._candidate and (endpoint is None or self._candidate[1] > endpoint[1]):
+            endpoint = self._candidate
+        if endpoint is None: return
+        self.endpoint_mL, peak, baseline = endpoint
+        sharpness = max(0.0, 1 - max(baseline, 0.0) / peak)
+        fallen = min(1.0, max(0.0, 2 * (peak - self.slope) / peak))
+        self.confidence = sharpness * fallen
+
+    def state(self) -> dict:
+        """The estimates, as JSON compatible dict"""
+        return {"slope": self.slope, "curvature": self.curvature,
+                "endpoint_mL": self.endpoint_mL, "confidence": self.confidence}
+
+
+
+def detect_endpoints(volumes_mL: npt.ArrayLike, readouts: npt.ArrayLike) -> tuple[np.ndarray, np.ndarray]:
+    """`EndpointDetector` for many titrations at once: the endpoint it reports after the last readout
+
+    Args:
+        volumes_mL: the increasing volumes the readouts were taken at, shared by all titrations
+        readouts: the pH readouts, one row per titration (averaged per volume)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the endpoint volumes (NaN where none was passed), and their confidences.
+        None is passed before the 4th volume, so with fewer volumes all endpoints are NaN"""
+
+    x = np.asarray(volumes_mL, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(readouts, dtype=np.float64))
+    if x.size < 4:
+        # an inflection needs the curvature at two middle volumes
+        return np.full(y.shape[0], np.nan), np.zeros(y.shape[0])
+    segment_slopes = np.diff(y, axis=-1) / np.diff(x)
+    before, after = segment_slopes[:, :-1], segment_slopes[:, 1:]
+    left, right = x[1:-1] - x[:-2], x[2:] - x[1:-1]
+    slope = (before * right + after * left) / (left + right)
+    curvature = 2 * (after - before) / (left + right)
+
+    # inflections between two middle volumes, as in EndpointDetector._estimate
+    c0, c1 = curvature[:, :-1], curvature[:, 1:]
+    peak = np.maximum(slope[:, :-1], slope[:, 1:])
+    crossing = (c0 > 0) & (c1 <= 0) & (peak > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        location = x[1:-2] + (x[2:-1] - x[1:-2]) * c0 / (c0 - c1)
+        baseline = np.cumsum(slope, axis=-1)[:, :-1] / np.arange(1, slope.shape[1])
+
+    steepest = np.argmax(np.where(crossing, peak, -np.inf), axis=-1)
+    rows = np.arange(y.shape[0])
+    found = crossing[rows, steepest]
+    endpoint = np.where(found, location[rows, steepest], np.nan)
+    peak, baseline = peak[rows, steepest], baseline[rows, steepest]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpness = np.maximum(0.0, 1 - np.maximum(baseline, 0.0) / peak)
+        fallen = np.clip(2 * (peak - slope[:, -1]) / peak, 0.0, 1.0)
+    return endpoint, np.where(found, sharpness * fallen, 0.0)
+
+
+class MonteCarloResult(NamedTuple):
+    """Outcome of `monte_carlo_titrations`, one entry per titration"""
+    pka: np.ndarray
+    """pKa of the titrated acid"""
+    equivalence_mL: np.ndarray
+    """True volume of the equivalence point"""
+    endpoint_mL: np.ndarray
+    """Detected endpoint, NaN if none was detected"""
+    confidence: np.ndarray
+    """Confidence of the detected endpoint"""
+
+    @property
+    def error_mL(self) -> np.ndarray:
+        """Detected minus true endpoint"""
+        return self.endpoint_mL - self.equivalence_mL
+
+    def stats(self, min_confidence: float = 0.0) -> dict:
+        """Endpoint error statistics over the titrations detected with at least `min_confidence`"""
+        detected = ~np.isnan(self.endpoint_mL) & (self.confidence >= min_confidence)
+        error = self.error_mL[detected]
+        if not error.size: return {"runs": len(self.pka), "detected": 0.0}
+        absolute = np.abs(error)
+        return {
+            "runs": len(self.pka),
+            "detected": float(detected.mean()),
+            "mean_error_mL": float(error.mean()),
+            "sd_error_mL": float(error.std()),
+            "mean_abs_error_mL": float(absolute.mean()),
+            "p95_abs_error_mL": float(np.percentile(absolute, 95)),
+            "max_abs_error_mL": float(absolute.max()),
+        }
+
+
+def monte_carlo_titrations(runs: int, step_mL: float = 10.0, max_volume_mL: float = 800.0, noise_sd: float = 0.01,
+                           readouts_per_step: int = 1, seed: Optional[int] = None) -> MonteCarloResult:
+    """Simulate `runs` independent titrations like `pHMeter` does - random pKa, noisy readouts - as arrays,
+    each dosing `step_mL` up to `max_volume_mL`, and detect their endpoints with `detect_endpoints`
+
+    Args:
+        runs: number of titrations
+        step_mL: volume added per step
+        max_volume_mL: volume at which each titration stops
+        noise_sd: standard deviation of a single readout
+        readouts_per_step: readouts averaged per step
+        seed: seed for reproducible runs
+
+    Returns:
+        MonteCarloResult: per titration the pKa, the true and detected endpoint, see `MonteCarloResult.stats()`"""
+
+    rng = np.random.default_rng(seed)
+    meter = pHMeter(rng.spawn(1)[0])
+    volumes = np.arange(0, max_volume_mL + step_mL / 2, step_mL)
+    pkas = rng.integers(1, 5, size=runs, endpoint=True)
+
+    # the exact curve only depends on the pKa, so it is computed once per distinct pKa
+    distinct, index = np.unique(pkas, return_inverse=True)
+    curves = np.stack([meter.model(pka).pH(volumes) for pka in distinct])
+    readouts = rng.standard_normal((runs, volumes.size))
+    readouts *= noise_sd / np.sqrt(readouts_per_step)
+    readouts += curves[index]
+
+    endpoint, confidence = detect_endpoints(volumes, readouts)
+    equivalence = np.array([meter.model(pka).equivalence_volumes_mL[0] for pka in distinct])[index]
+    return MonteCarloResult(pkas.astype(np.float64), equivalence, endpoint, confidence)
 
 
 if __name__ == "__main__":
     phmeter = pHMeter()
-    for volume in np.linspace(0, 600, 50):
-        phmeter.added_volume_mL = volume
-        print("pH", phmeter.added_volume_mL, phmeter.pH, phmeter.tau)
\ No newline at end of file
+    volumes = np.linspace(0, 600, 50)
+    for volume, pH in zip(volumes, phmeter.curve(volumes, noise_sd=0)):
+        print("pH", volume, pH, volume * phmeter.titrant_conc_M / 1000 / phmeter.moles_to_titrate)
+    print("endpoint detection over 10000 titrations", monte_carlo_titrations(10000, seed=0).stats())
\ No newline at end of file
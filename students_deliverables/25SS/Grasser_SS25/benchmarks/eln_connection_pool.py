@@ -0,0 +1,86 @@
+"""Benchmark: requests/sec of the ELN API with a connection per request vs. the pooled WAL connections
+
+Drives the flask app in-process through its test client from several threads, so the numbers reflect
+routing, validation and database work but no network. Runs against a throwaway database in a temp dir, with the
+notebook cache disabled so that every request reaches the database.
+
+Usage:
+    python benchmarks/eln_connection_pool.py [--requests 4000] [--threads 8] [--notebooks 500]"""
+
+import argparse
+import contextlib
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+import automationserver.eln_server as eln_server
+from automationserver.cache import LRUCache
+from automationserver.eln_schema import register_functions
+from automationserver.sqlite_pool import SQLitePool
+
+
+class ConnectPerRequest(SQLitePool):
+    """Reproduces the previous behaviour: a fresh connection with default pragmas (rollback journal) per handler"""
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = sqlite3.connect(self.path, autocommit=True, timeout=self.busy_timeout_ms / 1000)
+        if self.on_connect:
+            self.on_connect(db)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def run(pool: SQLitePool, n_requests: int, n_threads: int, n_notebooks: int) -> float:
+    """Seed the database and run a mixed workload (70% GET, 20% query, 10% PUT). Returns requests/sec"""
+
+    eln_server.DB = pool
+    # a cached GET never checks out a connection, and entries would carry over from the previous run
+    eln_server.NOTEBOOK_CACHE = LRUCache(0)
+    eln_server.init_db(pool)
+    client = eln_server.app.test_client()
+
+    notebook = {"creator": "bench", "public": False, "title": "Benchmark notebook",
+                "content": "<p>" + "lorem ipsum " * 50 + "</p>", "tags": ["bench"]}
+    ids = [client.put("/api/", json=notebook).json["id"] for _ in range(n_notebooks)]
+
+    per_thread = n_requests // n_threads
+
+    def worker(offset: int):
+        for i in range(per_thread):
+            kind = (i + offset) % 10
+            if kind < 7:
+                client.get(f"/api/{ids[(i * 7 + offset) % len(ids)]}")
+            elif kind < 9:
+                client.post("/api/query", json={"user": "someone-else"})
+            else:
+                client.put("/api/", json=notebook)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+
+    return per_thread * n_threads / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--notebooks", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = run(ConnectPerRequest(pathlib.Path(tmp) / "before.sqlite", on_connect=register_functions), args.requests, args.threads, args.notebooks)
+        print(f"connection per request: {before:8.1f} req/s")
+
+        pool = SQLitePool(pathlib.Path(tmp) / "after.sqlite", max_connections=args.threads, on_connect=register_functions)
+        after = run(pool, args.requests, args.threads, args.notebooks)
+        pool.close_all()
+        print(f"pooled WAL connections: {after:8.1f} req/s  ({after / before:.2f}x)")
@@ -0,0 +1,101 @@
+"""Load test: latency percentiles and throughput of a running ELN server under a mixed read/write workload
+
+Start the server first, either mode, against a scratch database:
+
+    ELN_DB_PATH=/tmp/loadtest.sqlite python -m automationserver.eln_server
+    ELN_DB_PATH=/tmp/loadtest.sqlite uvicorn automationserver.eln_asgi:app --port 5001
+
+then run e.g.
+
+    python benchmarks/eln_loadtest.py --concurrency 32 --duration 20 --mix get=70,query=15,patch=10,create=5"""
+
+import argparse
+import random
+import statistics
+import threading
+import time
+
+import requests
+
+
+NOTEBOOK = {"creator": "loadtest", "public": False, "title": "Load test notebook",
+            "content": "<p>" + "titration buffer sodium hydroxide " * 40 + "</p>", "tags": ["loadtest"]}
+
+
+def seed(endpoint: str, n: int) -> list[int]:
+    """Create `n` notebooks through the batch API, returns their IDs"""
+    ids = []
+    for start in range(0, n, 1000):
+        batch = [{"op": "create", "notebook": NOTEBOOK} for _ in range(min(1000, n - start))]
+        ids += [res["id"] for res in requests.post(endpoint + "batch", json={"operations": batch}).json()["results"]]
+    return ids
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoint", default="http://localhost:5001/api/")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of client threads, each with a keep-alive session")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--notebooks", type=int, default=2000, help="notebooks to create before the run")
+    parser.add_argument("--mix", default="get=70,query=15,patch=10,create=5", help="relative weights of the operations")
+    args = parser.parse_args()
+
+    mix = {name: float(weight) for name, weight in (part.split("=") for part in args.mix.split(","))}
+    ids = seed(args.endpoint, args.notebooks)
+    latencies: dict[str, list[float]] = {name: [] for name in mix}
+    errors: dict[str, int] = {name: 0 for name in mix}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        session = requests.Session()
+        local = {name: [] for name in mix}
+        local_errors = {name: 0 for name in mix}
+        names, weights = list(mix), list(mix.values())
+
+        while time.perf_counter() < deadline:
+            op = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            if op == "get":
+                res = session.get(args.endpoint + str(rng.choice(ids)))
+            elif op == "query":
+                res = session.post(args.endpoint + "query", json={"user": "loadtest", "query": rng.choice(["titration", "buffer", "sodium"]), "projection": "summary"})
+            elif op == "patch":
+                res = session.patch(args.endpoint + str(rng.choice(ids)), json={"title": f"Edited {rng.random()}"})
+            elif op == "create":
+                res = session.put(args.endpoint, json=NOTEBOOK)
+            else:
+                raise ValueError(f"Unknown operation {op}")
+            local[op].append(time.perf_counter() - start)
+            if not res.ok: local_errors[op] += 1
+
+        with lock:
+            for name in mix:
+                latencies[name] += local[name]
+                errors[name] += local_errors[name]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{'operation':<10}{'count':>9}{'errors':>8}{'p50 ms':>9}{'p99 ms':>9}{'mean ms':>9}")
+    all_latencies = []
+    for name, values in latencies.items():
+        if not values: continue
+        all_latencies += values
+        values.sort()
+        print(f"{name:<10}{len(values):>9}{errors[name]:>8}{percentile(values, 50) * 1000:>9.2f}{percentile(values, 99) * 1000:>9.2f}{statistics.fmean(values) * 1000:>9.2f}")
+    all_latencies.sort()
+    print(f"{'total':<10}{len(all_latencies):>9}{sum(errors.values()):>8}{percentile(all_latencies, 50) * 1000:>9.2f}{percentile(all_latencies, 99) * 1000:>9.2f}{statistics.fmean(all_latencies) * 1000:>9.2f}")
+    print(f"throughput: {len(all_latencies) / elapsed:.1f} req/s with {args.concurrency} clients")
+
+
+if __name__ == "__main__":
+    main()
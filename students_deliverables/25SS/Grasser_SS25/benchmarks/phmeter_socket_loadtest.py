@@ -0,0 +1,91 @@
+"""Load test: hundreds of concurrent Socket.IO clients on the pH meter channel of a running main_server
+
+Every client connects, subscribes to a bench and titrates every few seconds. Clients are spread over `--benches`
+shared benches, so each titration is broadcast to all viewers of its bench. Reports connect latency, the round trip
+from a titration to the client seeing its result, and the rate of received broadcasts.
+
+Needs the asyncio client of python-socketio (`pip install "python-socketio[asyncio_client]"`). Start the server
+(or the scaled deployment of `docker-compose.scale.yaml`) first, then run e.g.
+
+    python benchmarks/phmeter_socket_loadtest.py --url http://localhost:5000 --clients 500 --benches 50 --duration 30"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import socketio
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+async def client(args, index: int, stats: dict, deadline: float):
+    """One simulated viewer: connect, subscribe, titrate every `--action-interval` seconds until the deadline"""
+    bench = f"loadtest-{index % args.benches}"
+    sio = socketio.AsyncClient(reconnection=False)
+    pending: list[tuple[float, float]] = []
+    """Titrations awaiting their result: send time, and the volume the bench shows at least once it is applied"""
+    seen = {"volume": 0.0}
+
+    @sio.on("phmeter")
+    async def on_phmeter(message):
+        stats["messages"] += 1
+        volume = message.get("volume_added", 0.0)
+        seen["volume"] = volume
+        # other clients titrate on the same bench, so the volume only bounds when our titration is visible
+        while pending and volume >= pending[0][1]:
+            stats["action_s"].append(time.perf_counter() - pending.pop(0)[0])
+
+    start = time.perf_counter()
+    try:
+        # the bench in the URL lets a sticky load balancer route all viewers of a bench to one instance
+        await sio.connect(f"{args.url}?bench={bench}", transports=["websocket"], wait_timeout=10)
+    except (socketio.exceptions.ConnectionError, asyncio.TimeoutError):
+        stats["connect_errors"] += 1
+        return
+    stats["connect_s"].append(time.perf_counter() - start)
+
+    await sio.emit("phmeter", {"action": "subscribe", "bench": bench})
+    rng = random.Random(index)
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.uniform(0.5, 1.5) * args.action_interval)
+        pending.append((time.perf_counter(), seen["volume"] + 0.5 - 1e-9))
+        await sio.emit("phmeter", {"action": "add_volume", "volume": 0.5, "bench": bench})
+    await sio.disconnect()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=200, help="number of concurrent socket clients")
+    parser.add_argument("--benches", type=int, default=20, help="number of shared benches the clients are spread over")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which the clients connect")
+    parser.add_argument("--action-interval", type=float, default=2, help="mean seconds between titrations per client")
+    args = parser.parse_args()
+
+    stats = {"connect_s": [], "action_s": [], "messages": 0, "connect_errors": 0}
+    start = time.perf_counter()
+    deadline = start + args.ramp + args.duration
+
+    async def delayed(index: int):
+        await asyncio.sleep(index * args.ramp / args.clients)
+        await client(args, index, stats, deadline)
+
+    await asyncio.gather(*(delayed(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{'metric':<12}{'count':>9}{'p50 ms':>9}{'p99 ms':>9}{'mean ms':>9}")
+    for name in ("connect_s", "action_s"):
+        values = sorted(stats[name])
+        if not values: continue
+        print(f"{name[:-2]:<12}{len(values):>9}{percentile(values, 50) * 1000:>9.2f}{percentile(values, 99) * 1000:>9.2f}{statistics.fmean(values) * 1000:>9.2f}")
+    print(f"connect errors: {stats['connect_errors']}")
+    print(f"broadcasts received: {stats['messages']} ({stats['messages'] / elapsed:.1f}/s over {args.clients} clients)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+import pytest
+
+from automationserver import eln_schema, eln_server
+from automationserver.cache import LRUCache
+from automationserver.file_store import ContentStore
+from automationserver.sqlite_pool import SQLitePool
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    pool = SQLitePool(tmp_path / "eln.sqlite", on_connect=eln_schema.register_functions)
+    monkeypatch.setattr(eln_server, "DB", pool)
+    monkeypatch.setattr(eln_server, "FILE_STORE", ContentStore(tmp_path / "blobs"))
+    monkeypatch.setattr(eln_server, "NOTEBOOK_CACHE", LRUCache(16))
+    eln_server.init_db(pool)
+    yield eln_server.app.test_client()
+    pool.close_all()
+
+
+def _notebook(client, creator, public=False):
+    return client.put("/api/", json={"creator": creator, "public": public, "title": "t", "content": "c"}).json["id"]
+
+
+def _upload(client, id, data, user=None):
+    headers = {"X-ELN-User": user} if user else {}
+    return client.put(f"/api/{id}/files?name=data.csv&creator=alice", data=data, headers=headers)
+
+
+def test_blob_is_deleted_with_its_last_reference(client):
+    first, second = _notebook(client, "alice"), _notebook(client, "alice")
+    digest = _upload(client, first, b"1,2,3").json["uuid"]
+    _upload(client, second, b"1,2,3")
+    assert eln_server.FILE_STORE.exists(digest)
+
+    assert client.delete(f"/api/{first}").status_code == 200
+    assert eln_server.FILE_STORE.exists(digest)  # still attached to the second notebook
+
+    assert client.delete(f"/api/{second}/files/{digest}").status_code == 200
+    assert not eln_server.FILE_STORE.exists(digest)
+
+
+def test_blob_is_deleted_when_patched_away(client):
+    id = _notebook(client, "alice")
+    digest = _upload(client, id, b"x").json["uuid"]
+    assert client.patch(f"/api/{id}", json={"files": []}).status_code == 200
+    assert not eln_server.FILE_STORE.exists(digest)
+
+
+def test_files_of_private_notebooks_need_permission(client):
+    private, public = _notebook(client, "alice"), _notebook(client, "alice", public=True)
+    digest = _upload(client, private, b"secret").json["uuid"]
+    _upload(client, public, b"open")
+
+    assert client.get(f"/api/{private}/files/{digest}", headers={"X-ELN-User": "mallory"}).status_code == 401
+    assert client.get(f"/api/{private}/files/{digest}", headers={"X-ELN-User": "alice"}).status_code == 200
+    assert _upload(client, private, b"more", user="mallory").status_code == 401
+    assert client.delete(f"/api/{private}/files/{digest}", headers={"X-ELN-User": "mallory"}).status_code == 401
+    assert eln_server.FILE_STORE.exists(digest)
+
+    public_digest = client.get(f"/api/{public}").json["files"][0]["uuid"]
+    assert client.get(f"/api/{public}/files/{public_digest}", headers={"X-ELN-User": "mallory"}).status_code == 200
@@ -0,0 +1,33 @@
+import pytest
+
+from automationserver import eln_schema, eln_server
+from automationserver.cache import LRUCache
+from automationserver.sqlite_pool import SQLitePool
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    pool = SQLitePool(tmp_path / "eln.sqlite", on_connect=eln_schema.register_functions)
+    monkeypatch.setattr(eln_server, "DB", pool)
+    monkeypatch.setattr(eln_server, "NOTEBOOK_CACHE", LRUCache(16))
+    eln_server.init_db(pool)
+    client = eln_server.app.test_client()
+    for title in ("titration", "calibration"):
+        client.put("/api/", json={"creator": "alice", "public": True, "title": title, "content": "<p>buffer</p>"})
+    yield client
+    pool.close_all()
+
+
+@pytest.mark.parametrize("text", ["?!", "--", " . "])
+def test_query_without_words_matches_nothing(client, text):
+    page = client.post("/api/query", json={"query": text}).json
+    assert page == {"results": [], "next_cursor": None}
+
+    streamed = client.post("/api/query", json={"query": text}, headers={"Accept": "application/x-ndjson"})
+    assert streamed.status_code == 200 and streamed.get_data(as_text=True) == ""
+
+
+def test_query_matches_words(client):
+    assert len(client.post("/api/query", json={"query": "titr"}).json["results"]) == 1
+    assert len(client.post("/api/query", json={"query": "buffer!"}).json["results"]) == 2
+    assert len(client.post("/api/query", json={}).json["results"]) == 2
@@ -0,0 +1,51 @@
+import statistics
+
+from automationserver import instrument_stream
+from automationserver.instrument_stream import SampleBroadcaster
+
+
+class FakeSocketIO:
+    """Runs the broadcaster on a fake clock: every `sleep` advances it and calls `on_tick` with the tick number"""
+
+    def __init__(self, monkeypatch, on_tick):
+        self.now = 0.0
+        self.ticks = 0
+        self.emitted = []
+        self.on_tick = on_tick
+        monkeypatch.setattr(instrument_stream.time, "monotonic", lambda: self.now)
+
+    def emit(self, event, message, to=None):
+        self.emitted.append(message)
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.ticks += 1
+        self.on_tick(self.ticks)
+
+
+def _average(samples):
+    return samples[-1] | {"pH": statistics.fmean(sample["pH"] for sample in samples)}
+
+
+def test_change_between_broadcasts_is_not_averaged_with_older_samples(monkeypatch):
+    instrument = {"pH": 2.0, "volume_added": 0.0}
+    broadcaster = None
+
+    def on_tick(tick):
+        if tick == 6:
+            # titrate between two broadcast ticks, like the `add_volume` handler
+            instrument.update(pH=12.5, volume_added=420.0)
+            broadcaster.publish()
+        elif tick == 10:
+            broadcaster._subscribers.clear()
+
+    socketio = FakeSocketIO(monkeypatch, on_tick)
+    broadcaster = SampleBroadcaster(socketio, "phmeter", "room", lambda: dict(instrument),
+                                    sample_interval_s=0.25, broadcast_interval_s=1.0, coalesce=_average)
+    broadcaster._subscribers.add("sid")
+    broadcaster._run()
+
+    periodic = [message for message in socketio.emitted if message["volume_added"] == 420.0]
+    assert periodic[0] == {"pH": 12.5, "volume_added": 420.0}  # the published sample
+    assert all(message["pH"] == 12.5 for message in periodic)
+    assert len(periodic) >= 2
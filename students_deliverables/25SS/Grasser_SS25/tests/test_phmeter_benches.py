@@ -0,0 +1,29 @@
+import pytest
+
+from automationserver import main_server
+
+
+@pytest.fixture
+def registries(monkeypatch):
+    monkeypatch.setattr(main_server.PHMETER_BENCHES, "max_instruments", 2)
+    monkeypatch.setattr(main_server.PHMETER_SHARED_BENCHES, "max_instruments", 2)
+    monkeypatch.setattr(main_server.PHMETER_BENCHES, "_entries", {})
+    monkeypatch.setattr(main_server.PHMETER_SHARED_BENCHES, "_entries", {})
+    return main_server.PHMETER_BENCHES, main_server.PHMETER_SHARED_BENCHES
+
+
+def test_shared_benches_do_not_evict_own_benches(registries):
+    own, shared = registries
+    owner = main_server.socketio.test_client(main_server.app)
+    owner.emit("phmeter", {"action": "add_volume", "volume": 5})
+    own_ids = list(own._entries)
+
+    other = main_server.socketio.test_client(main_server.app)
+    for name in ("a", "b", "c", "d"):
+        other.emit("phmeter", {"action": "poll", "bench": name})
+
+    assert list(own._entries) == own_ids
+    assert own.peek(own_ids[0]).meter.added_volume_mL == 5
+    assert sorted(shared._entries) == ["bench:c", "bench:d"]
+    owner.disconnect()
+    other.disconnect()
@@ -0,0 +1,16 @@
+from automationserver import tracing
+from automationserver.sqlite_pool import SQLitePool
+
+
+def test_statements_are_traced_by_kind(tmp_path):
+    pool = SQLitePool(tmp_path / "traced.sqlite")
+    with pool.transaction() as db:
+        db.execute("CREATE TABLE t(x)")
+        db.executemany("INSERT INTO t VALUES (?)", [(1,), (2,)])
+    with pool.connection() as db:
+        assert db.execute("SELECT count(*) FROM t").fetchone() == (2,)
+    pool.close_all()
+
+    metrics = tracing.metrics_response().get_data(as_text=True)
+    for op in ("CREATE", "INSERT", "SELECT", "BEGIN", "COMMIT"):
+        assert f'span_seconds_count{{span="sqlite.query",db="traced",op="{op}"}}' in metrics
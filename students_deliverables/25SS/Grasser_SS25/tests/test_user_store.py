@@ -0,0 +1,33 @@
+import pytest
+
+from automationserver import user_store
+from automationserver.user_store import UserStore
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """Two stores on the same database, like a server and the command line (or two instances)"""
+    monkeypatch.setattr(user_store, "SCRYPT_N", 2**4)
+    server, cli = UserStore(tmp_path / "users.sqlite"), UserStore(tmp_path / "users.sqlite")
+    server.migrate()
+    return server, cli
+
+
+def test_password_changed_by_another_store_takes_effect(stores, monkeypatch):
+    server, cli = stores
+    cli.add("alice", "old")
+    assert server.authenticate("alice", "old")
+
+    cli.set_password("alice", "new")
+    now = user_store.time.monotonic()
+    monkeypatch.setattr(user_store.time, "monotonic", lambda: now + server.cache_ttl_s)
+
+    assert server.authenticate("alice", "old") is None
+    assert server.authenticate("alice", "new")
+
+
+def test_user_added_by_another_store_can_log_in(stores):
+    server, cli = stores
+    assert server.authenticate("bob", "pw") is None
+    cli.add("bob", "pw")
+    assert server.authenticate("bob", "pw")